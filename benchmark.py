@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+from astropy.io import fits
+from colorama import Fore, Style
+
+import script
+from fake_siril import open_fake_siril, LOG_ENV
+from scheduler import format_bytes
+from tracing import tree_snapshot
+
+FRAME_LEVELS = {'biases': 0.02, 'darks': 0.03, 'flats': 0.45, 'lights': 0.05}
+FRAME_EXPOSURES = {'biases': 0.001, 'darks': 60.0, 'flats': 1.0, 'lights': 60.0}
+STAR_COUNT = 150
+NOISE = 0.004
+
+# Script functions that do their work in Python rather than through Siril, timed as their own stages.
+PYTHON_STAGES = {
+    'check_directories': 'scan',
+    'move_to_calibrated_folder': 'move',
+    'filter_frames': 'quality',
+    'combine_frames': 'native_stack',
+    'calibrate_frames': 'native_calibrate',
+    'cleanup': 'cleanup',
+}
+
+
+def vignetting(height, width):
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r2 = ((x - width / 2) / width) ** 2 + ((y - height / 2) / height) ** 2
+    return 1 - 0.6 * r2
+
+
+def star_field(rng, height, width):
+    image = np.zeros((height, width), dtype=np.float32)
+    offsets = np.arange(-3, 4)
+    psf = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * 1.2 ** 2)).astype(np.float32)
+    ys = rng.integers(3, height - 3, STAR_COUNT)
+    xs = rng.integers(3, width - 3, STAR_COUNT)
+    for y, x, flux in zip(ys, xs, rng.uniform(0.05, 0.6, STAR_COUNT)):
+        image[y - 3:y + 4, x - 3:x + 4] += flux * psf
+    return image
+
+
+def write_frame(path, data, exptime, bayerpat):
+    data = np.clip(np.round(data * 65535), 0, 65535).astype(np.uint16)
+    header = fits.Header({'EXPTIME': exptime})
+    if bayerpat:
+        header['BAYERPAT'] = bayerpat
+    fits.PrimaryHDU(data=data, header=header).writeto(path, overwrite=True)
+
+
+def generate_tree(workdir, sessions=2, lights=10, darks=5, flats=5, biases=5, width=640, height=480, cfa=False,
+                  seed=0):
+    """Create session folders laid out like setup_directories, filled with synthetic 16-bit FITS frames."""
+    rng = np.random.default_rng(seed)
+    vignette = vignetting(height, width)
+    stars = star_field(rng, height, width)
+    hot = (rng.integers(0, height, 50), rng.integers(0, width, 50))
+    counts = {'lights': lights, 'darks': darks, 'flats': flats, 'biases': biases}
+
+    os.makedirs(os.path.join(workdir, 'calibrated'), exist_ok=True)
+    for session_num in range(1, sessions + 1):
+        session_dir = os.path.join(workdir, f"session_{session_num}")
+        for folder, count in counts.items():
+            if not count:
+                continue
+            frame_dir = os.path.join(session_dir, folder)
+            os.makedirs(frame_dir, exist_ok=True)
+            for index in range(1, count + 1):
+                data = np.full((height, width), FRAME_LEVELS[folder], dtype=np.float32)
+                if folder in ('darks', 'lights'):
+                    data[hot] += 0.3
+                if folder == 'flats':
+                    data *= vignette
+                if folder == 'lights':
+                    shift = rng.integers(-4, 5, 2)
+                    data += np.roll(stars, tuple(shift), axis=(0, 1)) * vignette
+                data += rng.normal(0, NOISE, data.shape).astype(np.float32)
+                write_frame(os.path.join(frame_dir, f"IMG_{index:04d}.fit"), data, FRAME_EXPOSURES[folder],
+                            'RGGB' if cfa else None)
+    return workdir
+
+
+def tree_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DiskSampler(threading.Thread):
+    def __init__(self, directory, interval):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.samples.append((time.time(), tree_size(self.directory)))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.samples.append((time.time(), tree_size(self.directory)))
+
+    def peak(self, start=None, end=None):
+        inside = [size for moment, size in self.samples
+                  if (start is None or moment >= start) and (end is None or moment <= end)]
+        if not inside:
+            # Stages shorter than the sampling interval fall back to the last sample before they ended.
+            inside = [size for moment, size in self.samples if end is None or moment <= end][-1:]
+        return max(inside, default=0)
+
+
+def time_python_stage(function, stage, directory, log_path):
+    def timed(*args, **kwargs):
+        # Files are keyed by inode and mtime so renamed or moved frames do not count as written.
+        before = {(ino, mtime) for _, ino, mtime in tree_snapshot(directory).values()}
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            end = time.time()
+            written = sum(size for size, ino, mtime in tree_snapshot(directory).values()
+                          if (ino, mtime) not in before)
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'stage': stage, 'start': start, 'end': end, 'frames': None,
+                                    'bytes': written, 'pid': os.getpid()}) + '\n')
+    return timed
+
+
+def summarize(log_path, sampler):
+    stages = {}
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            stage = stages.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'peak': 0})
+            stage['calls'] += 1
+            stage['seconds'] += record['end'] - record['start']
+            stage['bytes'] += record['bytes']
+            stage['peak'] = max(stage['peak'], sampler.peak(record['start'], record['end']))
+    return stages
+
+
+def run_benchmark(root, sessions, lights, width, height, bit_depth, cfa=False, calibration=5, workers=1,
+                  engine='siril', budget=None, batch=0, cache=False, compression=None, link=False, scratch=None,
+                  interval=0.05, quantization=0):
+    workdir = os.path.join(root, f"bench_{sessions}x{lights}_{width}x{height}_{bit_depth}")
+    if os.path.isdir(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    generate_tree(workdir, sessions, lights, calibration, calibration, calibration, width, height, cfa)
+    inputs = tree_size(workdir)
+
+    log_path = os.path.join(root, os.path.basename(workdir) + '_stages.jsonl')
+    if os.path.isfile(log_path):
+        os.remove(log_path)
+    os.environ[LOG_ENV] = log_path
+
+    settings = {'session_workers': workers, 'calibration_engine': engine, 'disk_budget_bytes': budget,
+                'stack_batch_size': batch, 'master_cache': cache, 'compression': compression,
+                'compression_quantization': quantization, 'fits_link': link, 'scratch_dir': scratch}
+    originals = {name: getattr(script, name) for name in PYTHON_STAGES}
+    for name, stage in PYTHON_STAGES.items():
+        setattr(script, name, time_python_stage(originals[name], stage, workdir, log_path))
+
+    cwd = os.getcwd()
+    sampler = DiskSampler(workdir, interval)
+    sampler.start()
+    start = time.time()
+    try:
+        with script.job_settings(settings):
+            script.process_workdir(workdir, None, bit_depth, os.path.join(root, 'masters') if cache else None,
+                                   open_fake_siril, interactive=False)
+    finally:
+        wall = time.time() - start
+        sampler.stop()
+        os.chdir(cwd)
+        for name, value in originals.items():
+            setattr(script, name, value)
+        del os.environ[LOG_ENV]
+
+    stages = summarize(log_path, sampler)
+    return {
+        'sessions': sessions, 'lights': lights, 'width': width, 'height': height, 'bit_depth': bit_depth,
+        'cfa': cfa, 'workers': workers, 'engine': engine, 'wall': wall, 'inputs': inputs,
+        'written': sum(stage['bytes'] for stage in stages.values()),
+        'peak': sampler.peak() - inputs, 'stages': stages, 'workdir': workdir,
+    }
+
+
+def print_result(result):
+    print(Fore.BLUE + f"{result['sessions']} session(s) x {result['lights']} lights, "
+                      f"{result['width']}x{result['height']}, {result['bit_depth']} bits"
+                      f"{', CFA' if result['cfa'] else ''}, {result['workers']} worker(s), "
+                      f"{result['engine']} engine" + Style.RESET_ALL)
+    print(f"  {'stage':<18}{'calls':>7}{'seconds':>10}{'written':>13}{'peak disk':>13}")
+    for name, stage in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"  {name:<18}{stage['calls']:>7}{stage['seconds']:>10.2f}{format_bytes(stage['bytes']):>13}"
+              f"{format_bytes(max(stage['peak'] - result['inputs'], 0)):>13}")
+    print(Fore.GREEN + f"  total {result['wall']:.2f} s, {format_bytes(result['written'])} written, "
+                       f"peak {format_bytes(result['peak'])} above the inputs" + Style.RESET_ALL)
+    print(" ")
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the multi-session pipeline on synthetic data against a "
+                                                 "stand-in Siril. List arguments are run as a grid.")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[2])
+    parser.add_argument('--lights', type=int, nargs='+', default=[10])
+    parser.add_argument('--size', type=parse_size, nargs='+', default=[(640, 480)], help="WIDTHxHEIGHT")
+    parser.add_argument('--bits', choices=['16', '32'], nargs='+', default=['32'])
+    parser.add_argument('--calibration', type=int, default=5, help="darks, flats and biases per session")
+    parser.add_argument('--cfa', action='store_true', help="write Bayer (RGGB) frames instead of mono")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', choices=['siril', 'native'], default='siril')
+    parser.add_argument('--budget', type=int, default=None, help="DISK_BUDGET_BYTES")
+    parser.add_argument('--batch', type=int, default=0, help="STACK_BATCH_SIZE")
+    parser.add_argument('--cache', action='store_true', help="enable the master cache")
+    parser.add_argument('--compression', choices=['rice', 'gzip1', 'gzip2', 'hcompress'], default=None,
+                        help="COMPRESSION for intermediates")
+    parser.add_argument('--quantization', type=int, default=0,
+                        help="COMPRESSION_QUANTIZATION (0 = lossless, gzip1/gzip2 only for 32 bits)")
+    parser.add_argument('--link', action='store_true', help="FITS_LINK: link FITS frames instead of converting")
+    parser.add_argument('--scratch', default=None, help="SCRATCH_DIR for intermediates")
+    parser.add_argument('--interval', type=float, default=0.05, help="disk sampling interval in seconds")
+    parser.add_argument('--root', default=None, help="directory for the synthetic trees (default: temporary)")
+    parser.add_argument('--keep', action='store_true', help="keep the generated trees")
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='siril_bench_')
+    os.makedirs(root, exist_ok=True)
+    results = []
+    try:
+        for sessions in args.sessions:
+            for lights in args.lights:
+                for width, height in args.size:
+                    for bit_depth in args.bits:
+                        result = run_benchmark(root, sessions, lights, width, height, bit_depth, args.cfa,
+                                               args.calibration, args.workers, args.engine, args.budget,
+                                               args.batch, args.cache, args.compression, args.link,
+                                               args.scratch, args.interval, args.quantization)
+                        print_result(result)
+                        results.append(result)
+                        if not args.keep:
+                            shutil.rmtree(result['workdir'])
+    finally:
+        if not args.keep and not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if len(results) > 1:
+        print(f"{'sessions':>8}{'lights':>8}{'size':>12}{'bits':>6}{'seconds':>10}{'written':>13}{'peak':>13}")
+        for result in results:
+            print(f"{result['sessions']:>8}{result['lights']:>8}{result['width']:>6}x{result['height']:<5}"
+                  f"{result['bit_depth']:>6}{result['wall']:>10.2f}{format_bytes(result['written']):>13}"
+                  f"{format_bytes(result['peak']):>13}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
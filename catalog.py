@@ -0,0 +1,200 @@
+import os
+import re
+import sqlite3
+import rawpy
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import frame_number, read_header
+from rawconvert import read_exif
+
+FITS_EXTENSIONS = ('.fit', '.fits', '.fit.fz', '.fits.fz')
+RAW_EXTENSIONS = ('.raw', '.nef', '.cr2', '.cr3', '.arw')
+
+FRAME_FOLDERS = {'lights': 'light', 'darks': 'dark', 'flats': 'flat', 'biases': 'bias'}
+
+CONVERSION_LINE = re.compile(r"^'?(.+?)'?\s*->\s*'?(.+?)'?\s*$")
+
+
+def read_frame_info(file_path):
+    if file_path.lower().endswith(FITS_EXTENSIONS):
+        header = read_header(file_path)
+        naxis = header.get('NAXIS', 0)
+        return {
+            'width': header.get('NAXIS1'),
+            'height': header.get('NAXIS2'),
+            'channels': header.get('NAXIS3', 1) if naxis == 3 else 1,
+            'bitpix': header.get('BITPIX'),
+            'bayerpat': header.get('BAYERPAT'),
+            'exptime': header.get('EXPTIME', header.get('EXPOSURE')),
+            'gain': header.get('GAIN', header.get('ISOSPEED')),
+            'temperature': header.get('CCD-TEMP', header.get('SET-TEMP')),
+        }
+
+    exif = read_exif(file_path)
+    raw = rawpy.RawPy()
+    try:
+        raw.open_file(file_path)
+        return {
+            'width': raw.sizes.width,
+            'height': raw.sizes.height,
+            'channels': 1,
+            'bitpix': 16,
+            'bayerpat': raw.color_desc.decode('ascii', 'replace') if raw.num_colors >= 3 else None,
+            'exptime': exif.get('exptime'),
+            'gain': exif.get('iso'),
+            'temperature': None,
+        }
+    finally:
+        raw.close()
+
+
+def frame_color(row):
+    if row['channels'] == 3 or row['bayerpat']:
+        return 'color'
+    if row['channels'] == 1:
+        return 'mono'
+    return None
+
+
+class FrameCatalog:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS frames (
+                path TEXT PRIMARY KEY,
+                session TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                channels INTEGER,
+                bitpix INTEGER,
+                bayerpat TEXT,
+                exptime REAL,
+                gain REAL,
+                temperature REAL
+            );
+            CREATE TABLE IF NOT EXISTS calibrated (
+                number INTEGER PRIMARY KEY,
+                source TEXT
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, workdir, threads=8):
+        known = {row['path']: (row['size'], row['mtime_ns'])
+                 for row in self.connection.execute("SELECT path, size, mtime_ns FROM frames")}
+        seen = set()
+        stale = []
+
+        for session in sorted(os.listdir(workdir)):
+            session_path = os.path.join(workdir, session)
+            if not session.startswith('session_') or not os.path.isdir(session_path):
+                continue
+            for folder, kind in FRAME_FOLDERS.items():
+                folder_path = os.path.join(session_path, folder)
+                if not os.path.isdir(folder_path):
+                    continue
+                for name in sorted(os.listdir(folder_path)):
+                    if not name.lower().endswith(FITS_EXTENSIONS + RAW_EXTENSIONS):
+                        continue
+                    path = os.path.join(folder_path, name)
+                    stat = os.stat(path)
+                    seen.add(path)
+                    if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                        stale.append((path, session, kind, stat))
+
+        def read(entry):
+            try:
+                return entry, read_frame_info(entry[0]), None
+            except Exception as e:
+                return entry, None, e
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for (path, session, kind, stat), info, error in executor.map(read, stale):
+                if error is not None:
+                    errors.append((path, error))
+                    continue
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO frames VALUES "
+                    "(:path, :session, :kind, :size, :mtime_ns, :width, :height, :channels, :bitpix, :bayerpat, "
+                    ":exptime, :gain, :temperature)",
+                    dict(info, path=path, session=session, kind=kind, size=stat.st_size,
+                         mtime_ns=stat.st_mtime_ns))
+
+        prefix = os.path.join(workdir, '')
+        for path in known:
+            if path.startswith(prefix) and path not in seen:
+                self.connection.execute("DELETE FROM frames WHERE path = ?", (path,))
+        self.connection.commit()
+        return errors
+
+    def frames(self, session=None, kind=None):
+        query = "SELECT * FROM frames WHERE 1 = 1"
+        params = []
+        if session is not None:
+            query += " AND session = ?"
+            params.append(session)
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        return [dict(row) for row in self.connection.execute(query + " ORDER BY path", params)]
+
+    def summary(self):
+        summary = {}
+        for row in self.frames(kind='light'):
+            counts = summary.setdefault(row['session'], {'lights': 0, 'color': 0, 'mono': 0})
+            counts['lights'] += 1
+            color = frame_color(row)
+            if color:
+                counts[color] += 1
+        return summary
+
+    def last_calibrated_number(self):
+        return self.connection.execute("SELECT COALESCE(MAX(number), 0) FROM calibrated").fetchone()[0]
+
+    def add_calibrated(self, number, source):
+        self.connection.execute("INSERT OR REPLACE INTO calibrated VALUES (?, ?)", (number, source))
+
+    def commit(self):
+        self.connection.commit()
+
+    def calibrated_sources(self):
+        return {row[0]: row[1] for row in self.connection.execute("SELECT number, source FROM calibrated")}
+
+    def clear_calibrated(self):
+        self.connection.execute("DELETE FROM calibrated")
+        self.connection.commit()
+
+    def calibrated_exptime(self, number):
+        row = self.connection.execute(
+            "SELECT frames.exptime FROM calibrated LEFT JOIN frames ON frames.path = calibrated.source "
+            "WHERE calibrated.number = ?", (number,)).fetchone()
+        return row[0] if row else None
+
+
+def read_conversion_file(process_dir, source_dir, basename='light'):
+    sources = {}
+    conversion_file = os.path.join(process_dir, basename + '_conversion.txt')
+    if os.path.isfile(conversion_file):
+        with open(conversion_file, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = CONVERSION_LINE.match(line.strip())
+                if not match:
+                    continue
+                number = frame_number(match.group(2))
+                if number is not None:
+                    sources[number] = os.path.join(source_dir, match.group(1))
+    elif os.path.isdir(source_dir):
+        names = [name for name in sorted(os.listdir(source_dir))
+                 if name.lower().endswith(FITS_EXTENSIONS + RAW_EXTENSIONS)]
+        for number, name in enumerate(names, start=1):
+            sources[number] = os.path.join(source_dir, name)
+    return sources
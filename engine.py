@@ -0,0 +1,240 @@
+import os
+import numpy as np
+
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import image_hdu, read_header
+
+TILE_ROWS = 128
+CLIP_ITERATIONS = 3
+HOT_PIXEL_SIGMA = 5.0
+MEDIAN_SAMPLE_ROWS = 16
+COMPRESSION_TYPES = {'rice': 'RICE_1', 'gzip1': 'GZIP_1', 'gzip2': 'GZIP_2', 'hcompress': 'HCOMPRESS_1'}
+
+
+def image_info(path):
+    header = read_header(path)
+    if header['NAXIS'] == 3:
+        shape = (header['NAXIS3'], header['NAXIS2'], header['NAXIS1'])
+    else:
+        shape = (header['NAXIS2'], header['NAXIS1'])
+    return header, shape
+
+
+def data_scale(header):
+    # Siril works on [0, 1] floats, integer FITS are rescaled the same way.
+    if header.get('BITPIX') == 16:
+        return 1.0 / 65535
+    if header.get('BITPIX') == 8:
+        return 1.0 / 255
+    return 1.0
+
+
+def open_frame(path):
+    # Astropy only memory-maps integer frames left unscaled, read_rows applies BZERO and BSCALE itself.
+    return fits.open(path, memmap=True, do_not_scale_image_data=True)
+
+
+def read_rows(hdul, y0, y1, scale):
+    hdu = image_hdu(hdul)
+    data = hdu.section[:, y0:y1, :] if hdu.header['NAXIS'] == 3 else hdu.section[y0:y1, :]
+    data = np.asarray(data, dtype=np.float32)
+    bscale, bzero = hdu.header.get('BSCALE', 1), hdu.header.get('BZERO', 0)
+    if bscale != 1 or bzero:
+        data = data * np.float32(bscale) + np.float32(bzero)
+    return data * np.float32(scale)
+
+
+def frame_median(path):
+    header, shape = image_info(path)
+    scale = data_scale(header)
+    step = max(shape[-2] // MEDIAN_SAMPLE_ROWS, 1)
+    with open_frame(path) as hdul:
+        samples = [read_rows(hdul, y, y + 1, scale) for y in range(0, shape[-2], step)]
+    return float(np.median(np.concatenate([sample.ravel() for sample in samples])))
+
+
+def winsorized_sigma(masked, center):
+    # Winsorizing the sample keeps a single bright outlier from inflating sigma on small stacks.
+    sigma = np.nanstd(masked, axis=0)
+    for _ in range(CLIP_ITERATIONS):
+        winsorized = np.clip(masked, center - 1.5 * sigma, center + 1.5 * sigma)
+        sigma = 1.134 * np.nanstd(winsorized, axis=0)
+    return sigma
+
+
+def sigma_clip_mean(stack, sigma_low, sigma_high):
+    mask = np.ones(stack.shape, dtype=bool)
+    for _ in range(CLIP_ITERATIONS):
+        masked = np.where(mask, stack, np.nan)
+        center = np.nanmedian(masked, axis=0)
+        sigma = winsorized_sigma(masked, center)
+        clipped = mask & (stack >= center - sigma_low * sigma) & (stack <= center + sigma_high * sigma)
+        if np.array_equal(clipped, mask):
+            break
+        mask = clipped
+    counts = mask.sum(axis=0)
+    mean = np.where(mask, stack, 0).sum(axis=0) / np.maximum(counts, 1)
+    return np.where(counts > 0, mean, np.median(stack, axis=0)).astype(np.float32)
+
+
+def check_compression(compression, bit_depth, quantization):
+    """The FITS compression type for a codec, refusing combinations Siril cannot write as configured."""
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSION_TYPES)}")
+    if bit_depth != '16' and not quantization and not compression.startswith('gzip'):
+        # Unquantized floats are only stored losslessly by the gzip codecs.
+        raise ValueError(f"{compression} cannot store 32-bit frames without quantization, use gzip1 or gzip2 or "
+                         f"set COMPRESSION_QUANTIZATION")
+    return COMPRESSION_TYPES[compression]
+
+
+def write_fits(path, data, header, bit_depth, compression=None, quantization=16):
+    header = header.copy()
+    for key in ('BZERO', 'BSCALE'):
+        header.remove(key, ignore_missing=True)
+    if bit_depth == '16':
+        data = np.clip(np.round(data * 65535), 0, 65535).astype(np.uint16)
+    else:
+        data = data.astype(np.float32)
+    if not compression:
+        fits.PrimaryHDU(data=data, header=header).writeto(path, overwrite=True)
+        return
+    compression_type = check_compression(compression, bit_depth, quantization)
+    for key in ('XTENSION', 'PCOUNT', 'GCOUNT', 'SIMPLE', 'EXTEND'):
+        header.remove(key, ignore_missing=True)
+    hdu = fits.CompImageHDU(data=data, header=header, compression_type=compression_type,
+                            quantize_level=quantization or 0)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+def combine_band(paths, y0, y1, sigma_low, sigma_high, scales, subtract, tile_rows):
+    hduls = [open_frame(path) for path in paths]
+    master = open_frame(subtract) if subtract else None
+    try:
+        input_scale = data_scale(image_hdu(hduls[0]).header)
+        master_scale = data_scale(image_hdu(master).header) if master else 1.0
+        factors = np.asarray(scales, dtype=np.float32).reshape((-1,) + (1,) * image_hdu(hduls[0]).header['NAXIS'])
+        tiles = []
+        for t0 in range(y0, y1, tile_rows):
+            t1 = min(t0 + tile_rows, y1)
+            stack = np.stack([read_rows(hdul, t0, t1, input_scale) for hdul in hduls])
+            if master:
+                stack -= read_rows(master, t0, t1, master_scale)
+            tiles.append(sigma_clip_mean(stack * factors, sigma_low, sigma_high))
+        return y0, np.concatenate(tiles, axis=-2)
+    finally:
+        for hdul in hduls:
+            hdul.close()
+        if master:
+            master.close()
+
+
+def combine_frames(paths, output, sigma_low=3, sigma_high=3, normalize=False, subtract=None, bit_depth='32',
+                   workers=None, tile_rows=TILE_ROWS, compression=None, quantization=16):
+    header, shape = image_info(paths[0])
+    scales = np.ones(len(paths))
+    if normalize:
+        medians = np.array([frame_median(path) for path in paths])
+        scales = np.median(medians) / np.where(medians > 0, medians, 1)
+
+    workers = workers or os.cpu_count() or 1
+    band = max(-(-shape[-2] // workers), tile_rows)
+    result = np.empty(shape, dtype=np.float32)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(combine_band, paths, y0, min(y0 + band, shape[-2]), sigma_low, sigma_high,
+                                   scales, subtract, tile_rows)
+                   for y0 in range(0, shape[-2], band)]
+        for future in futures:
+            y0, rows = future.result()
+            result[..., y0:y0 + rows.shape[-2], :] = rows
+
+    header['STACKCNT'] = len(paths)
+    write_fits(output, result, header, bit_depth, compression, quantization)
+    return output
+
+
+def load_master(path):
+    header, _ = image_info(path)
+    with fits.open(path) as hdul:
+        return np.asarray(image_hdu(hdul).data, dtype=np.float32) * np.float32(data_scale(header))
+
+
+def prepare_masters(process_dir, dark=None, flat=None, cfa=False):
+    masters = {'dark': None, 'flat': None, 'hot': None}
+
+    if dark:
+        data = load_master(dark)
+        masters['dark'] = os.path.join(process_dir, 'native_dark.npy')
+        np.save(masters['dark'], data)
+
+        plane = data if data.ndim == 2 else data.mean(axis=0)
+        median = np.median(plane)
+        sigma = 1.4826 * np.median(np.abs(plane - median))
+        masters['hot'] = os.path.join(process_dir, 'native_hot.npy')
+        np.save(masters['hot'], np.argwhere(plane > median + HOT_PIXEL_SIGMA * max(sigma, 1e-6)))
+
+    if flat:
+        data = load_master(flat)
+        if cfa and data.ndim == 2:
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    channel = data[dy::2, dx::2]
+                    channel /= max(float(channel.mean()), 1e-6)
+        elif data.ndim == 3:
+            for channel in data:
+                channel /= max(float(channel.mean()), 1e-6)
+        else:
+            data /= max(float(data.mean()), 1e-6)
+        data[data <= 0] = 1
+        masters['flat'] = os.path.join(process_dir, 'native_flat.npy')
+        np.save(masters['flat'], data)
+
+    return masters
+
+
+def fix_hot_pixels(image, hot, distance):
+    if not len(hot):
+        return
+    ys, xs = hot[:, 0], hot[:, 1]
+    height, width = image.shape[-2], image.shape[-1]
+    neighbours = [(np.clip(ys + dy, 0, height - 1), np.clip(xs + dx, 0, width - 1))
+                  for dy, dx in ((-distance, 0), (distance, 0), (0, -distance), (0, distance))]
+    if image.ndim == 2:
+        image[ys, xs] = np.median([image[ny, nx] for ny, nx in neighbours], axis=0)
+    else:
+        for channel in image:
+            channel[ys, xs] = np.median([channel[ny, nx] for ny, nx in neighbours], axis=0)
+
+
+def calibrate_light(source, output, masters, cfa, bit_depth, compression=None, quantization=16,
+                    tile_rows=TILE_ROWS):
+    header, shape = image_info(source)
+    scale = data_scale(header)
+    dark = np.load(masters['dark'], mmap_mode='r') if masters['dark'] else None
+    flat = np.load(masters['flat'], mmap_mode='r') if masters['flat'] else None
+
+    result = np.empty(shape, dtype=np.float32)
+    with open_frame(source) as hdul:
+        for y0 in range(0, shape[-2], tile_rows):
+            y1 = min(y0 + tile_rows, shape[-2])
+            tile = read_rows(hdul, y0, y1, scale)
+            if dark is not None:
+                tile -= dark[..., y0:y1, :]
+            if flat is not None:
+                tile /= flat[..., y0:y1, :]
+            result[..., y0:y1, :] = tile
+
+    if masters['hot']:
+        fix_hot_pixels(result, np.load(masters['hot']), 2 if cfa else 1)
+    write_fits(output, result, header, bit_depth, compression, quantization)
+    return output
+
+
+def calibrate_frames(sources, outputs, masters, cfa, bit_depth, workers=None, compression=None, quantization=16):
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(calibrate_light, source, output, masters, cfa, bit_depth, compression,
+                                   quantization)
+                   for source, output in zip(sources, outputs)]
+        return [future.result() for future in futures]
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import shlex
+import numpy as np
+import rawpy
+
+from astropy.io import fits
+
+from catalog import FITS_EXTENSIONS, RAW_EXTENSIONS
+from engine import image_info, data_scale, write_fits
+from sequence import write_seq_for_files
+from utils import image_hdu, is_frame, frame_suffix, FRAME_SUFFIXES
+
+LOG_ENV = 'FAKE_SIRIL_LOG'
+
+
+def load_frame(path):
+    if path.lower().endswith(RAW_EXTENSIONS):
+        with rawpy.imread(path) as raw:
+            header = fits.Header({'BAYERPAT': raw.color_desc.decode('ascii', 'replace')})
+            return np.asarray(raw.raw_image_visible, dtype=np.float32) / 65535, header
+    header, _ = image_info(path)
+    with fits.open(path) as hdul:
+        data = np.asarray(image_hdu(hdul).data, dtype=np.float32)
+    return data * np.float32(data_scale(header)), header
+
+
+def sequence_frames(directory, seqname):
+    seqname = seqname.rstrip('_') + '_'
+    frames = []
+    for file_name in sorted(os.listdir(directory)):
+        number_str = file_name[len(seqname):-len(frame_suffix(file_name))]
+        if is_frame(file_name, seqname) and number_str.isdigit():
+            frames.append((int(number_str), os.path.join(directory, file_name)))
+    return frames
+
+
+class FakeSiril:
+    """Stand-in for pysiril's Siril that reproduces the file I/O of the commands the script uses.
+
+    Every command appends a JSON line with its duration and bytes written to the file named by
+    the FAKE_SIRIL_LOG environment variable, so worker processes report into the same log.
+    """
+
+    def __init__(self, siril_exe=None):
+        self.siril_exe = siril_exe
+        self.cwd = os.getcwd()
+        self.bit_depth = '32'
+        self.compression = None
+        self.quantization = 16
+        self.bytes_written = 0
+
+    def Open(self):
+        return True
+
+    def Close(self):
+        return True
+
+    def Execute(self, command):
+        tokens = shlex.split(command)
+        if tokens and tokens[0] == 'setcompress':
+            self.compression = None
+            if tokens[1] == '1':
+                options = dict(token[1:].split('=', 1) for token in tokens if token.startswith('-') and '=' in token)
+                self.compression = options.get('type', 'rice')
+                self.quantization = float(tokens[-1]) if not tokens[-1].startswith('-') else 16
+        if tokens and tokens[0] == 'stack':
+            options = dict(token[1:].split('=', 1) for token in tokens if token.startswith('-') and '=' in token)
+            self.run('stack', self.stack, tokens[1], options.get('out'))
+        return True
+
+    def path(self, name):
+        return os.path.normpath(os.path.join(self.cwd, name))
+
+    @property
+    def ext(self):
+        return '.fit.fz' if self.compression else '.fit'
+
+    def find(self, name):
+        # Like Siril, image names given without an extension match either suffix.
+        for suffix in ('',) + FRAME_SUFFIXES:
+            if os.path.isfile(self.path(name + suffix)):
+                return self.path(name + suffix)
+        raise FileNotFoundError(self.path(name))
+
+    def write(self, path, data, header):
+        write_fits(path, data, header, self.bit_depth, self.compression, self.quantization)
+        self.bytes_written += os.path.getsize(path)
+
+    def run(self, stage, method, *args):
+        start = time.time()
+        written = self.bytes_written
+        frames = method(*args)
+        log_path = os.environ.get(LOG_ENV)
+        if log_path:
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'stage': stage, 'start': start, 'end': time.time(), 'frames': frames,
+                                    'bytes': self.bytes_written - written, 'pid': os.getpid()}) + '\n')
+
+    def convert(self, basename, out, start):
+        out_dir = self.path(out) if out else self.cwd
+        sources = [file_name for file_name in sorted(os.listdir(self.cwd))
+                   if file_name.lower().endswith(FITS_EXTENSIONS + RAW_EXTENSIONS)]
+        numbers = range(start, start + len(sources))
+        lines = []
+        for number, file_name in zip(numbers, sources):
+            data, header = load_frame(os.path.join(self.cwd, file_name))
+            self.write(os.path.join(out_dir, f"{basename}_{number:05d}{self.ext}"), data, header)
+            lines.append(f"'{file_name}' -> '{basename}_{number:05d}{self.ext}'\n")
+        write_seq_for_files(out_dir, basename + '_')
+        with open(os.path.join(out_dir, basename + '_conversion.txt'), 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        return len(sources)
+
+    def calibrate(self, seqname, dark, flat, bias, debayer, prefix='pp_'):
+        masters = {}
+        for name, master in (('dark', dark), ('flat', flat), ('bias', bias)):
+            if master:
+                masters[name] = load_frame(self.find(master))[0]
+        if 'flat' in masters:
+            masters['flat'] = masters['flat'] / max(float(masters['flat'].mean()), 1e-6)
+            masters['flat'][masters['flat'] <= 0] = 1
+
+        frames = sequence_frames(self.cwd, seqname)
+        for number, path in frames:
+            data, header = load_frame(path)
+            if 'bias' in masters:
+                data -= masters['bias']
+            if 'dark' in masters:
+                data -= masters['dark']
+            if 'flat' in masters:
+                data /= masters['flat']
+            if debayer and data.ndim == 2:
+                data = np.stack([data, data, data])
+            output = os.path.join(self.cwd, f"{prefix}{seqname.rstrip('_')}_{number:05d}{self.ext}")
+            self.write(output, data, header)
+        write_seq_for_files(self.cwd, prefix + seqname.rstrip('_') + '_')
+        return len(frames)
+
+    def register(self, seqname, prefix='r_'):
+        frames = sequence_frames(self.cwd, seqname)
+        for number, path in frames:
+            data, header = load_frame(path)
+            output = os.path.join(self.cwd, f"{prefix}{seqname.rstrip('_')}_{number:05d}{self.ext}")
+            self.write(output, data, header)
+        write_seq_for_files(self.cwd, prefix + seqname.rstrip('_') + '_')
+        return len(frames)
+
+    def stack(self, seqname, out=None):
+        frames = sequence_frames(self.cwd, seqname)
+        total = None
+        count = 0
+        for _, path in frames:
+            data, header = load_frame(path)
+            weight = header.get('STACKCNT', 1)
+            total = data * weight if total is None else total + data * weight
+            count += weight
+        header['STACKCNT'] = count
+        output = self.path(out if out else seqname.rstrip('_') + '_stacked') + self.ext
+        self.write(output, total / max(count, 1), header)
+        return len(frames)
+
+
+class FakeWrapper:
+    """Subset of pysiril's Wrapper used by script.py, backed by FakeSiril."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def cd(self, directory):
+        self.app.cwd = self.app.path(directory)
+
+    def set16bits(self):
+        self.app.bit_depth = '16'
+
+    def set32bits(self):
+        self.app.bit_depth = '32'
+
+    def setext(self, ext):
+        pass
+
+    def convert(self, basename, out=None, start=1, **options):
+        self.app.run('convert', self.app.convert, basename, out, start)
+
+    def calibrate(self, seqname, dark=None, flat=None, bias=None, debayer=False, **options):
+        self.app.run('calibrate', self.app.calibrate, seqname, dark, flat, bias, debayer)
+
+    def register(self, seqname, **options):
+        self.app.run('register', self.app.register, seqname)
+
+    def stack(self, seqname, out=None, **options):
+        self.app.run('stack', self.app.stack, seqname, out)
+
+
+def open_fake_siril(siril_exe, bit_depth):
+    # Imported here so the stand-in is configured exactly like a real instance without a circular import.
+    from script import open_siril
+    return open_siril(siril_exe, bit_depth, FakeSiril, FakeWrapper)
@@ -0,0 +1,65 @@
+import os
+import json
+
+from datetime import datetime
+
+from utils import is_frame
+
+
+def count_frames(directory, prefix):
+    if not os.path.isdir(directory):
+        return 0
+    return sum(1 for file_name in os.listdir(directory) if is_frame(file_name, prefix))
+
+
+class StageJournal:
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.stages = json.load(f)
+
+    def done(self, stage):
+        entry = self.stages.get(stage)
+        if entry is None:
+            return False
+        if not all(os.path.exists(path) for path in entry['outputs']):
+            return False
+        for directory, prefix, count in entry['frames']:
+            if count_frames(directory, prefix) < count:
+                return False
+        return True
+
+    def mark(self, stage, outputs=(), frames=()):
+        """Record a finished stage. Frames are (directory, prefix) or (directory, prefix, expected count).
+
+        Siril reports failed commands through return values, so a stage whose outputs are missing or whose
+        sequence does not hold the expected number of frames raises instead of being recorded.
+        """
+        missing = [os.path.basename(path) for path in outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"{stage} did not produce {', '.join(missing)}")
+        counted = []
+        for directory, prefix, *expected in frames:
+            count = count_frames(directory, prefix)
+            if expected and count != expected[0]:
+                raise RuntimeError(f"{stage} left {count} {prefix} frames in {directory}, expected {expected[0]}")
+            counted.append([directory, prefix, count])
+        self.stages[stage] = {
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'outputs': list(outputs),
+            'frames': counted,
+        }
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def reset(self):
+        self.stages = {}
+        if os.path.isfile(self.path):
+            os.remove(self.path)
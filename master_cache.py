@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+
+from utils import link_or_copy
+
+SAMPLE_BYTES = 64 * 1024
+
+
+class MasterCache:
+    def __init__(self, directory, max_bytes, bit_depth):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bit_depth = bit_depth
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, frame_dir, kind, params):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'kind': kind, 'bits': self.bit_depth, 'params': params},
+                                 sort_keys=True).encode('utf-8'))
+        for name in sorted(os.listdir(frame_dir)):
+            path = os.path.join(frame_dir, name)
+            if not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            digest.update(f"{size}\n".encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read(SAMPLE_BYTES))
+                if size > 2 * SAMPLE_BYTES:
+                    f.seek(-SAMPLE_BYTES, os.SEEK_END)
+                    digest.update(f.read(SAMPLE_BYTES))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.fit')
+
+    def fetch(self, key, dest):
+        cached = self.path(key)
+        if not os.path.isfile(cached):
+            return False
+        link_or_copy(cached, dest)
+        os.utime(cached)
+        return True
+
+    def store(self, key, src):
+        if not os.path.isfile(src):
+            return
+        tmp = self.path(key) + f".{os.getpid()}.tmp"
+        link_or_copy(src, tmp)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.fit') and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
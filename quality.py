@@ -0,0 +1,103 @@
+import os
+import csv
+import numpy as np
+
+from colorama import Fore, Style
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import open_frame, read_rows
+from utils import image_hdu, is_frame
+
+METRICS = ('background', 'noise', 'stars', 'fwhm')
+STAR_SIGMA = 5.0
+STAR_WINDOW = 2
+MAX_FWHM_STARS = 200
+MIN_RELATIVE_SPREAD = 0.02
+
+
+def bin_image(data, factor):
+    if data.ndim == 3:
+        data = data.mean(axis=0)
+    height = data.shape[0] // factor * factor
+    width = data.shape[1] // factor * factor
+    return data[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+
+def frame_scores(file_path, factor):
+    with open_frame(file_path) as hdul:
+        image = bin_image(read_rows(hdul, 0, image_hdu(hdul).header['NAXIS2'], 1.0), factor)
+
+    background = float(np.median(image))
+    noise = float(1.4826 * np.median(np.abs(image - background)))
+
+    core = image[1:-1, 1:-1]
+    peaks = core > background + STAR_SIGMA * noise
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                peaks &= core >= image[1 + dy:image.shape[0] - 1 + dy, 1 + dx:image.shape[1] - 1 + dx]
+    ys, xs = np.nonzero(peaks)
+    ys += 1
+    xs += 1
+    stars = len(ys)
+
+    fwhm = float('nan')
+    inside = ((ys >= STAR_WINDOW) & (ys < image.shape[0] - STAR_WINDOW)
+              & (xs >= STAR_WINDOW) & (xs < image.shape[1] - STAR_WINDOW))
+    ys, xs = ys[inside], xs[inside]
+    if len(ys):
+        brightest = np.argsort(image[ys, xs])[::-1][:MAX_FWHM_STARS]
+        ys, xs = ys[brightest], xs[brightest]
+        offsets = np.arange(-STAR_WINDOW, STAR_WINDOW + 1)
+        windows = image[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+        weights = np.clip(windows - background, 0, None)
+        total = weights.sum(axis=(1, 2))
+        valid = total > 0
+        if valid.any():
+            weights = weights[valid] / total[valid, None, None]
+            dy2 = (weights * (offsets[None, :, None] ** 2)).sum(axis=(1, 2))
+            dx2 = (weights * (offsets[None, None, :] ** 2)).sum(axis=(1, 2))
+            sigma = np.sqrt((dx2 + dy2) / 2)
+            fwhm = float(np.median(2.3548 * sigma) * factor)
+
+    return {'background': background, 'noise': noise, 'stars': stars, 'fwhm': fwhm}
+
+
+def robust_z(values):
+    values = np.asarray(values, dtype=np.float64)
+    median = np.nanmedian(values)
+    mad = max(1.4826 * np.nanmedian(np.abs(values - median)), abs(median) * MIN_RELATIVE_SPREAD)
+    if not mad:
+        return np.zeros_like(values)
+    return (values - median) / mad
+
+
+def filter_frames(calibrated_folder, report_path, thresholds, bin_factor=2, threads=4, prefix='pp_light_'):
+    frames = sorted(file_name for file_name in os.listdir(calibrated_folder) if is_frame(file_name, prefix))
+    if len(frames) < 3:
+        return []
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        scores = list(executor.map(lambda name: frame_scores(os.path.join(calibrated_folder, name), bin_factor),
+                                   frames))
+
+    z = {metric: robust_z([score[metric] for score in scores]) for metric in METRICS}
+    # Stars are rejected when too few are found, every other metric when it is too high.
+    z['stars'] = -z['stars']
+
+    rejected = []
+    with open(report_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(('frame',) + METRICS + ('rejected', 'reason'))
+        for index, (file_name, score) in enumerate(zip(frames, scores)):
+            reasons = [metric for metric in METRICS
+                       if metric in thresholds and np.nan_to_num(z[metric][index]) > thresholds[metric]]
+            writer.writerow([file_name] + [round(score[metric], 3) for metric in METRICS]
+                            + [bool(reasons), ' '.join(reasons)])
+            if reasons:
+                rejected.append(file_name)
+                print(Fore.YELLOW + f"Rejecting {file_name}: {', '.join(reasons)}" + Style.RESET_ALL)
+                os.remove(os.path.join(calibrated_folder, file_name))
+
+    print(Fore.CYAN + f"Quality filter kept {len(frames) - len(rejected)} of {len(frames)} frames." + Style.RESET_ALL)
+    return rejected
@@ -0,0 +1,120 @@
+import os
+import struct
+import numpy as np
+import rawpy
+
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import write_fits
+from sequence import write_seq_for_files, sequence_names, write_conversion_file
+
+TIFF_RAW_EXTENSIONS = ('.cr2', '.nef', '.arw')
+EXIF_READ_BYTES = 1024 * 1024
+EXIF_IFD_TAG = 0x8769
+EXPOSURE_TIME_TAG = 0x829A
+ISO_SPEED_TAG = 0x8827
+DATE_TIME_TAG = 0x9003
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 8: 2, 9: 4, 10: 8}
+
+
+def read_exif(file_path):
+    """Exposure, ISO and capture time from the EXIF block of TIFF-based raws (CR2, NEF, ARW)."""
+    if not file_path.lower().endswith(TIFF_RAW_EXTENSIONS):
+        return {}
+    with open(file_path, 'rb') as f:
+        data = f.read(EXIF_READ_BYTES)
+    order = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if order is None:
+        return {}
+
+    def read_ifd(offset):
+        entries = {}
+        count = struct.unpack_from(order + 'H', data, offset)[0]
+        for index in range(count):
+            tag, kind, length, value = struct.unpack_from(order + 'HHI4s', data, offset + 2 + 12 * index)
+            size = TYPE_SIZES.get(kind, 1) * length
+            if size > 4:
+                value = data[struct.unpack(order + 'I', value)[0]:][:size]
+            entries[tag] = (kind, value)
+        return entries
+
+    def decode(entry):
+        kind, value = entry
+        if kind == 2:
+            return value.split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+        if kind == 3:
+            return struct.unpack_from(order + 'H', value)[0]
+        if kind == 4:
+            return struct.unpack_from(order + 'I', value)[0]
+        if kind == 5:
+            numerator, denominator = struct.unpack_from(order + 'II', value)
+            return numerator / denominator if denominator else None
+        return None
+
+    try:
+        ifd0 = read_ifd(struct.unpack_from(order + 'I', data, 4)[0])
+        if EXIF_IFD_TAG not in ifd0:
+            return {}
+        exif = read_ifd(decode(ifd0[EXIF_IFD_TAG]))
+        info = {}
+        if EXPOSURE_TIME_TAG in exif:
+            info['exptime'] = decode(exif[EXPOSURE_TIME_TAG])
+        if ISO_SPEED_TAG in exif:
+            info['iso'] = decode(exif[ISO_SPEED_TAG])
+        if DATE_TIME_TAG in exif:
+            # EXIF writes dates as YYYY:MM:DD HH:MM:SS.
+            date, _, clock = decode(exif[DATE_TIME_TAG]).partition(' ')
+            info['date'] = date.replace(':', '-') + 'T' + clock
+        return info
+    except (struct.error, TypeError):
+        return {}
+
+
+def preconvertible(file_path):
+    # CR3 and .raw frames carry no EXIF this module can read, and a frame converted without its exposure
+    # time cannot be matched to darks, so those stay with Siril's convert.
+    return file_path.lower().endswith(TIFF_RAW_EXTENSIONS) and read_exif(file_path).get('exptime') is not None
+
+
+def bayer_pattern(raw):
+    if raw.raw_pattern is None or raw.raw_pattern.shape != (2, 2):
+        return None
+    desc = raw.color_desc.decode('ascii', 'replace')
+    return ''.join(desc[color] for color in raw.raw_colors_visible[:2, :2].flatten())
+
+
+def convert_raw(source, output, compression=None, quantization=16):
+    with rawpy.imread(source) as raw:
+        pattern = bayer_pattern(raw)
+        if pattern is None:
+            raise ValueError(f"{os.path.basename(source)} is not a Bayer raw")
+        data = raw.raw_image_visible.astype(np.float32) / 65535
+
+    header = fits.Header()
+    header['BAYERPAT'] = pattern
+    header['ROWORDER'] = 'TOP-DOWN'
+    exif = read_exif(source)
+    if exif.get('exptime') is not None:
+        header['EXPTIME'] = exif['exptime']
+    if exif.get('iso') is not None:
+        header['ISOSPEED'] = exif['iso']
+    if exif.get('date'):
+        header['DATE-OBS'] = exif['date']
+    write_fits(output, data, header, '16', compression, quantization)
+    return output
+
+
+def convert_raws(sources, out_dir, basename='light', start=1, workers=None, suffix='.fit', compression=None,
+                 quantization=16):
+    """Write CFA FITS for each raw as <basename>_NNNNN in out_dir, like Siril's convert, plus its .seq file."""
+    names = sequence_names(basename, start, len(sources), suffix)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(convert_raw, source, os.path.join(out_dir, name), compression, quantization)
+                   for source, name in zip(sources, names)]
+        for future in futures:
+            future.result()
+
+    write_conversion_file(out_dir, basename, sources, names)
+    write_seq_for_files(out_dir, basename + '_')
+    return [os.path.join(out_dir, name) for name in names]
@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import hashlib
+
+from utils import frame_suffix, link_or_copy
+
+MANIFEST = 'manifest.json'
+
+
+def lights_fingerprint(lights_dir):
+    # Names, sizes and modification times are enough to notice lights added to or removed from a session.
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(lights_dir)):
+        path = os.path.join(lights_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{name}\n{stat.st_size}\n{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class RetainedFrames:
+    """Registered lights kept per session between runs, with the registration reference and a manifest."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.staging = None
+        self.transfer = None
+        self.manifest = {'reference': None, 'sessions': {}}
+        path = os.path.join(directory, MANIFEST)
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def stage(self, staging, transfer):
+        """Keep newly retained frames in staging for this run and hand each one to transfer(src, dst) to store."""
+        self.staging = staging
+        self.transfer = transfer
+
+    def path(self, relative):
+        staged = os.path.join(self.staging, relative) if self.staging else None
+        return staged if staged and os.path.isfile(staged) else os.path.join(self.directory, relative)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, MANIFEST)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, path)
+
+    def sessions(self):
+        return sorted(self.manifest['sessions'])
+
+    def frames(self, session=None):
+        sessions = [session] if session else self.sessions()
+        return [self.path(os.path.join(name, file_name)) for name in sessions
+                for file_name in self.manifest['sessions'].get(name, {}).get('frames', [])]
+
+    def current(self, session_dir):
+        entry = self.manifest['sessions'].get(os.path.basename(session_dir))
+        lights_dir = os.path.join(session_dir, 'lights')
+        return (entry is not None and os.path.isdir(lights_dir) and entry['lights'] == lights_fingerprint(lights_dir)
+                and all(os.path.isfile(path) for path in self.frames(os.path.basename(session_dir))))
+
+    def reference(self):
+        reference = self.manifest['reference']
+        path = self.path(reference) if reference else None
+        return path if path and os.path.isfile(path) else None
+
+    def retain(self, session_dir, frames, reference=None):
+        """Move a session's registered frames (path, exposure) into the store, replacing what it held before."""
+        name = os.path.basename(session_dir)
+        for root in filter(None, (self.directory, self.staging)):
+            if os.path.isdir(os.path.join(root, name)):
+                shutil.rmtree(os.path.join(root, name))
+            os.makedirs(os.path.join(root, name))
+
+        file_names = []
+        for number, (path, _) in enumerate(frames, start=1):
+            file_name = f"r_pp_light_{number:05d}{frame_suffix(path)}"
+            if self.staging:
+                staged = os.path.join(self.staging, name, file_name)
+                shutil.move(path, staged)
+                self.transfer(staged, os.path.join(self.directory, name, file_name))
+            else:
+                shutil.move(path, os.path.join(self.directory, name, file_name))
+            file_names.append(file_name)
+            if path == reference:
+                self.manifest['reference'] = os.path.join(name, file_name)
+
+        self.manifest['sessions'][name] = {
+            'lights': lights_fingerprint(os.path.join(session_dir, 'lights')),
+            'frames': file_names,
+            'exptime': sum(exptime or 0 for _, exptime in frames),
+        }
+        if not self.reference() and file_names:
+            self.manifest['reference'] = os.path.join(name, file_names[0])
+        self.save()
+
+    def integration_time(self):
+        return int(sum(entry['exptime'] for entry in self.manifest['sessions'].values()))
+
+    def link_into(self, directory, prefix='r_pp_light_'):
+        frames = self.frames()
+        for number, path in enumerate(frames, start=1):
+            link_or_copy(path, os.path.join(directory, f"{prefix}{number:05d}{frame_suffix(path)}"))
+        return len(frames)
@@ -0,0 +1,117 @@
+import os
+
+from colorama import Fore, Style
+
+FITS_HEADER_BYTES = 2 * 2880
+MASTERS_PER_SESSION = 4
+CALIBRATION_KINDS = ('bias', 'flat', 'dark')
+
+
+def sample_bytes(bit_depth):
+    return 2 if bit_depth == '16' else 4
+
+
+def frame_bytes(row, bit_depth, debayer=False):
+    channels = 3 if debayer or row['channels'] == 3 else 1
+    return (row['width'] or 0) * (row['height'] or 0) * channels * sample_bytes(bit_depth) + FITS_HEADER_BYTES
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def split_chunks(lights, bit_depth, debayer, budget):
+    chunks = []
+    current = []
+    used = 0
+    for row in lights:
+        need = frame_bytes(row, bit_depth) + frame_bytes(row, bit_depth, debayer)
+        if current and used + need > budget:
+            chunks.append(current)
+            current = []
+            used = 0
+        current.append(row['path'])
+        used += need
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def session_lights(catalog, sessions):
+    return {session_dir: catalog.frames(session=os.path.basename(session_dir), kind='light')
+            for session_dir in sessions}
+
+
+def master_building_bytes(catalog, session_dir, bit_depth):
+    # Masters are stacked one kind at a time, each from its converted frames, and flats calibrated with a bias
+    # master sit on disk twice (flat_ and pp_flat_) until both sequences are cleaned up.
+    session = os.path.basename(session_dir)
+    frames = {kind: catalog.frames(session=session, kind=kind) for kind in CALIBRATION_KINDS}
+    copies = {'flat': 2 if frames['bias'] else 1}
+    return max(sum(frame_bytes(row, bit_depth) for row in rows) * copies.get(kind, 1) for kind, rows in frames.items())
+
+
+def kept_bytes(lights, bit_depth, debayer):
+    # Calibrated lights and masters stay on disk until the final stack, whatever the chunking.
+    calibrated = sum(frame_bytes(row, bit_depth, debayer) for rows in lights.values() for row in rows)
+    masters = sum(frame_bytes(rows[0], bit_depth) * MASTERS_PER_SESSION for rows in lights.values() if rows)
+    return calibrated, masters
+
+
+def estimate_peak(catalog, sessions, bit_depth, debayer):
+    """Bytes kept until the stack, and the most a single unchunked session adds on top while building its masters
+    or converting its lights."""
+    lights = session_lights(catalog, sessions)
+    calibrated, masters = kept_bytes(lights, bit_depth, debayer)
+    converted = max((sum(frame_bytes(row, bit_depth) for row in rows) for rows in lights.values()), default=0)
+    building = max((master_building_bytes(catalog, session_dir, bit_depth) for session_dir in sessions), default=0)
+    return calibrated + masters, max(converted, building)
+
+
+def plan_sessions(catalog, sessions, bit_depth, debayer, budget, workers=1):
+    """Split each session's lights into chunks that fit the budget. Returns the chunks per session, the number of
+    session workers that fit, and whether the masters of every session have to be built before any light is
+    calibrated."""
+    lights = session_lights(catalog, sessions)
+    calibrated, masters = kept_bytes(lights, bit_depth, debayer)
+    building = max(master_building_bytes(catalog, session_dir, bit_depth) for session_dir in sessions)
+    workers = max(workers, 1)
+    if workers > 1 and (budget - calibrated - masters) // workers < building:
+        workers = max(1, min(workers, (budget - calibrated - masters) // max(building, 1)))
+        print(Fore.YELLOW + f"Building masters takes up to {format_bytes(building)} per session, running "
+                            f"{workers} session worker(s) to stay within the budget." + Style.RESET_ALL)
+    transient = (budget - calibrated - masters) // workers
+
+    # Masters built up front only share the disk with the other masters, not with the calibrated lights.
+    masters_first = transient < building
+    peak = calibrated + masters + transient * workers
+    if masters_first:
+        peak = max(peak, masters + building)
+        if masters + building > budget:
+            print(Fore.RED + f"Disk budget {format_bytes(budget)} is below what building the masters needs "
+                             f"({format_bytes(masters + building)})." + Style.RESET_ALL)
+        print(Fore.CYAN + "Building the masters of every session before calibrating lights." + Style.RESET_ALL)
+
+    largest = max((frame_bytes(row, bit_depth) + frame_bytes(row, bit_depth, debayer)
+                   for rows in lights.values() for row in rows), default=0)
+    if transient < largest:
+        print(Fore.RED + f"Disk budget {format_bytes(budget)} is below the calibrated frames alone "
+                         f"({format_bytes(calibrated + masters)}). Calibrating one frame at a time."
+              + Style.RESET_ALL)
+        transient = largest
+        peak = max(peak, calibrated + masters + transient * workers)
+
+    plan = {session_dir: split_chunks(rows, bit_depth, debayer, transient) for session_dir, rows in lights.items()}
+
+    print(Fore.CYAN + f"Estimated peak disk use: {format_bytes(peak)} "
+                      f"(calibrated {format_bytes(calibrated)}, masters {format_bytes(masters)}, "
+                      f"master building {format_bytes(building)}, "
+                      f"convert/calibrate chunks {format_bytes(transient)} per worker)." + Style.RESET_ALL)
+    for session_dir, chunks in plan.items():
+        print(Fore.CYAN + f"{os.path.basename(session_dir)}: {len(lights[session_dir])} lights in "
+                          f"{len(chunks)} chunk(s)." + Style.RESET_ALL)
+    return plan, workers, masters_first
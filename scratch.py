@@ -0,0 +1,73 @@
+import os
+import queue
+import shutil
+import hashlib
+import threading
+
+from colorama import Fore, Style
+
+
+def scratch_root(scratch_dir, workdir):
+    # The path hash keeps two targets with the same folder name apart on a shared scratch volume.
+    workdir = os.path.abspath(workdir)
+    digest = hashlib.sha1(workdir.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(scratch_dir, f"{os.path.basename(workdir)}_{digest}")
+
+
+def scratch_free(scratch_dir):
+    os.makedirs(scratch_dir, exist_ok=True)
+    return shutil.disk_usage(scratch_dir).free
+
+
+def copy_file(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + '.tmp'
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CopyBack(threading.Thread):
+    """Copies finished files off the scratch volume in the background, in the order they were queued.
+    Copies are queued for a target, and a target with a failed copy keeps its scratch folder."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.tasks = queue.Queue()
+        self.errors = []
+        self.failed = set()
+        self.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                function, args, target = task
+                function(*args)
+            except Exception as e:
+                self.errors.append(e)
+                self.failed.add(target)
+                print(Fore.RED + f"Copy back failed: {e}" + Style.RESET_ALL)
+            finally:
+                self.tasks.task_done()
+
+    def copy(self, src, dst, target=None):
+        self.tasks.put((copy_file, (src, dst), target))
+
+    def remove(self, directory, target=None):
+        """Delete directory once every copy queued for target before it has succeeded, and keep it otherwise."""
+        self.tasks.put((self.remove_copied, (directory, target), target))
+
+    def remove_copied(self, directory, target):
+        if target in self.failed:
+            print(Fore.YELLOW + f"Keeping {directory}, not everything in it was copied back." + Style.RESET_ALL)
+            return
+        shutil.rmtree(directory, True)
+
+    def wait(self):
+        self.tasks.join()
+
+    def close(self):
+        self.tasks.put(None)
+        self.join()
@@ -1,9 +1,13 @@
 import os
+import json
+import time
 import shutil
+import argparse
+import threading
+import multiprocessing
 import tkinter
-import rawpy
+import queue
 
-from astropy.io import fits
 from pysiril.siril import *
 from pysiril.wrapper import *
 from tkinter.filedialog import askopenfilename
@@ -11,20 +15,128 @@ from colorama import init as colorama_init
 from colorama import Fore, Back, Style
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-
-from utils import log_error_to_file, has_spaces, calculate_integration_time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from utils import log_error_to_file, has_spaces, calculate_integration_time, frame_number, transfer_frame, \
+    link_or_copy, is_frame, frame_suffix, read_header
+from master_cache import MasterCache
+from catalog import FrameCatalog, read_conversion_file, read_frame_info, frame_color, FITS_EXTENSIONS, RAW_EXTENSIONS
+from journal import StageJournal, count_frames
+from sequence import write_seq_for_files, link_sequence, sequence_reference
+from retained import RetainedFrames
+from scratch import CopyBack, scratch_root, scratch_free
+from quality import filter_frames
+from scheduler import plan_sessions, estimate_peak, format_bytes
+from engine import combine_frames, prepare_masters, calibrate_frames, image_info, check_compression
+from rawconvert import convert_raws, preconvertible
+from tracing import (TRACE_FILE, traced, start_trace, add_trace_roots, stop_trace, trace_wrapper, record_deletion,
+                     print_summary)
 
 colorama_init()
 
-HAS_RGB_IMAGES = False
-HAS_MONO_IMAGES = False
-
 DEFAUT_SIRIL_PATH = "C:\\Program Files\\Siril\\bin\\siril.exe"
 
 STACKING_TYPE = "rej"      # stack type (sum|min|max|med|median|rej|mean)
 SIGMA_LOW = 3              # low threshold for sigma clipping rejection
 SIGMA_HIGH = 3             # high threshold for sigma clipping rejection
 NORMALIZATION = "addscale" # value are: no, add, addscale, mul or mulscale
+STACK_BATCH_SIZE = 0       # stack in sub-stacks of this many frames, then combine them (0 = single pass)
+
+CALIBRATION_ENGINE = "siril" # siril, or native for in-process NumPy calibration of FITS sessions
+NATIVE_WORKERS = None      # processes used by the native engine (None = all cores)
+
+SCAN_THREADS = 8           # threads reading frame headers into the frame catalog
+SESSION_WORKERS = 1        # number of Siril instances calibrating sessions in parallel (1 = serial)
+PIPELINE_LOOKAHEAD = 0     # sessions converted ahead on a second Siril while the current one calibrates (0 = off)
+DISK_BUDGET_BYTES = None   # cap on intermediate disk use; lights are calibrated in chunks to stay below it
+SCRATCH_DIR = None         # fast local folder (NVMe, tmpfs) for process/ and calibrated/ (None = beside the data)
+CALIBRATED_LINK = False    # rename/symlink calibrated lights instead of copying and write pp_light_.seq directly
+COMPRESSION = None         # rice, gzip1, gzip2 or hcompress to store intermediates and calibrated lights as .fit.fz
+COMPRESSION_QUANTIZATION = 0 # quantization of 32-bit data; 0 keeps it lossless (gzip1/gzip2 only)
+FITS_LINK = False          # hard-link FITS frames Siril reads as they are into process/ instead of converting them
+RAW_PRECONVERT = False     # convert CR2/NEF/ARW frames to CFA FITS with rawpy in parallel instead of Siril's convert
+RAW_WORKERS = None         # processes used for raw pre-conversion (None = all cores)
+INCREMENTAL = False        # keep registered lights per session in retained/ and only process new or changed sessions
+TRACE = False              # record per-stage timing and I/O to trace.jsonl in the working directory
+
+QUALITY_FILTER = False     # score calibrated lights and drop outliers before registration
+QUALITY_BIN = 2            # binning factor used when scoring frames
+QUALITY_THRESHOLDS = {'background': 3.0, 'noise': 3.0, 'stars': 3.0, 'fwhm': 3.0} # robust sigmas
+
+MASTER_CACHE = False                    # reuse master dark/bias/flat built from identical frame sets
+MASTER_CACHE_MAX_BYTES = 20 * 1024 ** 3 # oldest cached masters are evicted above this size
+MASTER_STACK_PARAMS = {'type': 'rej', 'sigma_low': 3, 'sigma_high': 3, 'norm': 'no'}
+
+INGEST_BATCH = 10          # lights calibrated together while ingesting during capture
+INGEST_SETTLE = 120        # seconds a calibration folder must be quiet to count as complete without a DONE file
+INGEST_POLL = 5            # seconds between checks of the watched folders
+INGEST_IDLE_TIMEOUT = None # stop ingesting after this many seconds without new lights (None = wait for lights/DONE)
+INGEST_MARKER = 'DONE'     # file dropped into lights/ (or a calibration folder) when capture is finished
+
+# Constants above that a batch job file may override per target, by their lowercase names.
+SETTINGS = ('STACKING_TYPE', 'SIGMA_LOW', 'SIGMA_HIGH', 'NORMALIZATION', 'STACK_BATCH_SIZE', 'CALIBRATION_ENGINE',
+            'NATIVE_WORKERS', 'SCAN_THREADS', 'SESSION_WORKERS', 'PIPELINE_LOOKAHEAD', 'DISK_BUDGET_BYTES',
+            'SCRATCH_DIR', 'CALIBRATED_LINK', 'COMPRESSION', 'COMPRESSION_QUANTIZATION', 'FITS_LINK',
+            'RAW_PRECONVERT', 'RAW_WORKERS', 'INCREMENTAL', 'TRACE', 'QUALITY_FILTER', 'QUALITY_BIN',
+            'QUALITY_THRESHOLDS', 'MASTER_CACHE', 'MASTER_CACHE_MAX_BYTES', 'MASTER_STACK_PARAMS', 'INGEST_BATCH',
+            'INGEST_SETTLE', 'INGEST_POLL', 'INGEST_IDLE_TIMEOUT')
+
+def frame_ext():
+    return '.fit.fz' if COMPRESSION else '.fit'
+
+
+def process_folder(session_dir):
+    if not SCRATCH_DIR:
+        return os.path.join(session_dir, 'process')
+    return os.path.join(scratch_root(SCRATCH_DIR, os.path.dirname(session_dir)), os.path.basename(session_dir),
+                        'process')
+
+
+def calibrated_path(workdir):
+    return os.path.join(scratch_root(SCRATCH_DIR, workdir) if SCRATCH_DIR else workdir, 'calibrated')
+
+
+def master_outputs(session_dir, process_dir):
+    # Biases are only stacked to calibrate flats, so a session without flats builds no bias master.
+    has_flats = os.path.isdir(os.path.join(session_dir, "flats"))
+    names = []
+    if has_flats and os.path.isdir(os.path.join(session_dir, "biases")):
+        names += ['bias_stacked', 'pp_flat_stacked']
+    elif has_flats:
+        names.append('flat_stacked')
+    if os.path.isdir(os.path.join(session_dir, "darks")):
+        names.append('dark_stacked')
+    return [os.path.join(process_dir, name + frame_ext()) for name in names]
+
+
+def light_count(session_dir):
+    return len(frame_files(os.path.join(session_dir, 'lights')))
+
+
+def calibrates_lights(has_rgb, has_mono, has_flats, has_darks, has_biases):
+    # Mirrors calibrate_lights: mono lights need flats or darks, color lights are skipped only with biases alone.
+    if has_flats or has_darks:
+        return True
+    return bool(has_rgb) and not has_biases
+
+
+def current_settings():
+    return {name.lower(): globals()[name] for name in SETTINGS}
+
+
+@contextmanager
+def job_settings(overrides):
+    unknown = [name for name in overrides if name.upper() not in SETTINGS]
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+    previous = {name: globals()[name] for name in SETTINGS}
+    globals().update({name.upper(): value for name, value in overrides.items()})
+    try:
+        yield
+    finally:
+        globals().update(previous)
+
 
 class CleanupHandler(FileSystemEventHandler):
     def __init__(self, directory, alt_prefix):
@@ -37,6 +149,17 @@ class CleanupHandler(FileSystemEventHandler):
             batch_cleanup(self.alt_prefix, file_path)
 
 
+class IngestHandler(FileSystemEventHandler):
+    def __init__(self, arrived):
+        self.arrived = arrived
+
+    def on_created(self, event):
+        self.arrived.set()
+
+    def on_moved(self, event):
+        self.arrived.set()
+
+
 def start_watchdog(directory, alt_prefix):
     event_handler = CleanupHandler(directory, alt_prefix)
     observer = Observer()
@@ -44,32 +167,631 @@ def start_watchdog(directory, alt_prefix):
     observer.start()
     return observer
 
-def master_dark(cmd, dark_dir, process_dir):
-    cmd.cd(dark_dir)
-    cmd.convert('dark', out=process_dir)
+def cached_master(cache, frame_dir, kind, params, output):
+    if cache is None:
+        return None, False
+    if COMPRESSION:
+        params = dict(params, compression=[COMPRESSION, COMPRESSION_QUANTIZATION])
+    key = cache.key(frame_dir, kind, params)
+    if cache.fetch(key, output):
+        print(Fore.GREEN + f"Master {kind} restored from cache." + Style.RESET_ALL)
+        return key, True
+    if os.path.exists(output):
+        os.remove(output)
+    return key, False
+
+
+@traced('master_dark')
+def master_dark(cmd, dark_dir, process_dir, cache=None):
+    output = os.path.join(process_dir, 'dark_stacked' + frame_ext())
+    key, hit = cached_master(cache, dark_dir, 'dark', MASTER_STACK_PARAMS, output)
+    if hit:
+        return key
+    convert_frames(cmd, dark_dir, 'dark', process_dir)
     cmd.cd(process_dir)
-    cmd.stack('dark', type='rej', sigma_low=3, sigma_high=3, norm='no')
+    cmd.stack('dark', **MASTER_STACK_PARAMS)
     cleanup(process_dir, 'dark')
-
-def master_bias(cmd, bias_dir, process_dir):
-    cmd.cd(bias_dir)
-    cmd.convert('bias', out=process_dir)
+    if key:
+        cache.store(key, output)
+    return key
+
+@traced('master_bias')
+def master_bias(cmd, bias_dir, process_dir, cache=None):
+    output = os.path.join(process_dir, 'bias_stacked' + frame_ext())
+    key, hit = cached_master(cache, bias_dir, 'bias', MASTER_STACK_PARAMS, output)
+    if hit:
+        return key
+    convert_frames(cmd, bias_dir, 'bias', process_dir)
     cmd.cd(process_dir)
-    cmd.stack('bias', type='rej', sigma_low=3, sigma_high=3, norm='no')
+    cmd.stack('bias', **MASTER_STACK_PARAMS)
     cleanup(process_dir, 'bias')
-
-
-def master_flat(cmd, flat_dir, process_dir, use_bias):
-    cmd.cd(flat_dir)
-    cmd.convert('flat', out=process_dir)
+    if key:
+        cache.store(key, output)
+    return key
+
+
+@traced('master_flat')
+def master_flat(cmd, flat_dir, process_dir, use_bias, cache=None, bias_key=None):
+    output = os.path.join(process_dir, ('pp_flat_stacked' if use_bias else 'flat_stacked') + frame_ext())
+    params = dict(MASTER_STACK_PARAMS, norm='mul')
+    key, hit = cached_master(cache, flat_dir, 'flat', dict(params, bias=bias_key if use_bias else None), output)
+    if hit:
+        return key
+    convert_frames(cmd, flat_dir, 'flat', process_dir)
     cmd.cd(process_dir)
     if use_bias:
         cmd.calibrate('flat', bias='bias_stacked')
-        cmd.stack('pp_flat', type='rej', sigma_low=3, sigma_high=3, norm='mul')
+        cmd.stack('pp_flat', **params)
         cleanup(process_dir, 'pp_flat')
     else:
-        cmd.stack('flat', type='rej', sigma_low=3, sigma_high=3, norm='mul')
+        cmd.stack('flat', **params)
     cleanup(process_dir, 'flat')
+    if key:
+        cache.store(key, output)
+    return key
+
+def process_session(cmd, session_dir, has_rgb, has_mono, cache=None, chunks=None, bit_depth='32'):
+    os.chdir(session_dir)
+    process_dir = process_folder(session_dir)
+
+    has_flats = os.path.isdir(os.path.join(session_dir, "flats"))
+    has_darks = os.path.isdir(os.path.join(session_dir, "darks"))
+    has_biases = os.path.isdir(os.path.join(session_dir, "biases"))
+
+    if not os.path.exists(process_dir):
+        os.makedirs(process_dir)
+
+    journal = session_journal(session_dir)
+    if not session_pending(session_dir):
+        print(Fore.GREEN + f"{os.path.basename(session_dir)} is already calibrated, skipping." + Style.RESET_ALL)
+        return
+
+    if CALIBRATION_ENGINE == 'native' and native_supported(session_dir):
+        process_session_native(cmd, session_dir, process_dir, has_flats, has_darks, has_biases, cache, bit_depth,
+                               journal)
+        journal.mark('calibrate', frames=[(process_dir, 'pp_light_', light_count(session_dir))])
+        return
+
+    build_masters(cmd, session_dir, process_dir, cache, journal)
+
+    if chunks and len(chunks) > 1:
+        calibrate_in_chunks(cmd, session_dir, process_dir, chunks, has_rgb, has_mono, has_flats, has_darks,
+                            has_biases)
+    else:
+        convert_lights(cmd, session_dir, process_dir, journal)
+        cmd.cd(process_dir)
+
+        observer = start_watchdog(process_dir, 'pp')
+        try:
+            calibrate_lights(cmd, has_rgb, has_mono, has_flats, has_darks, has_biases)
+        finally:
+            observer.stop()
+            observer.join()
+
+    expected = light_count(session_dir) if calibrates_lights(has_rgb, has_mono, has_flats, has_darks, has_biases) else 0
+    journal.mark('calibrate', frames=[(process_dir, 'pp_light_', expected)])
+
+
+def build_masters(cmd, session_dir, process_dir, cache, journal):
+    if journal.done('masters'):
+        return
+    has_flats = os.path.isdir(os.path.join(session_dir, "flats"))
+    has_darks = os.path.isdir(os.path.join(session_dir, "darks"))
+    has_biases = os.path.isdir(os.path.join(session_dir, "biases"))
+
+    if has_flats and has_biases:
+        bias_key = master_bias(cmd, os.path.join(session_dir, 'biases'), process_dir, cache)
+        master_flat(cmd, os.path.join(session_dir, 'flats'), process_dir, True, cache, bias_key)
+    elif has_flats:
+        master_flat(cmd, os.path.join(session_dir, 'flats'), process_dir, False, cache)
+
+    if has_darks:
+        master_dark(cmd, os.path.join(session_dir, 'darks'), process_dir, cache)
+    journal.mark('masters', outputs=master_outputs(session_dir, process_dir))
+
+
+def convert_lights(cmd, session_dir, process_dir, journal):
+    if not journal.done('convert'):
+        convert_frames(cmd, os.path.join(session_dir, 'lights'), 'light', process_dir)
+        journal.mark('convert', frames=[(process_dir, 'light_', light_count(session_dir))])
+
+
+def convert_frames(cmd, frame_dir, basename, process_dir, start=1):
+    # Builds the <basename>_ sequence in process_dir, going through Siril's convert only when it is needed.
+    sources = [os.path.join(frame_dir, file_name) for file_name in frame_files(frame_dir)]
+    if FITS_LINK and linkable_fits(sources):
+        link_frames(sources, process_dir, basename, start)
+        return
+    if RAW_PRECONVERT and sources and all(preconvertible(path) for path in sources):
+        try:
+            preconvert_raws(sources, process_dir, basename, start)
+            return
+        except ValueError as e:
+            print(Fore.YELLOW + f"{e}, converting with Siril instead." + Style.RESET_ALL)
+    cmd.cd(frame_dir)
+    cmd.convert(basename, out=process_dir, start=start)
+
+
+def linkable_fits(paths):
+    # Siril loads these frames directly: FITS in the configured compression with a 2D or RGB image of one shape.
+    if not paths or not all(path.lower().endswith(FITS_EXTENSIONS) for path in paths):
+        return False
+    if any(path.lower().endswith('.fz') != bool(COMPRESSION) for path in paths):
+        return False
+    shapes = set()
+    for path in paths:
+        header = read_header(path)
+        if header.get('NAXIS') not in (2, 3) or header.get('BITPIX') not in (8, 16, -32):
+            return False
+        if header['NAXIS'] == 3 and header.get('NAXIS3') not in (1, 3):
+            return False
+        shapes.add(tuple(header.get(f'NAXIS{axis}') for axis in range(1, header['NAXIS'] + 1)))
+    return len(shapes) == 1
+
+
+@traced('link')
+def link_frames(sources, process_dir, basename, start):
+    return link_sequence(sources, process_dir, basename, start, frame_ext())
+
+
+@traced('raw_preconvert')
+def preconvert_raws(sources, process_dir, basename, start):
+    print(Fore.CYAN + f"Converting {len(sources)} raw frames with rawpy." + Style.RESET_ALL)
+    return convert_raws(sources, process_dir, basename, start, RAW_WORKERS, frame_ext(), COMPRESSION,
+                        COMPRESSION_QUANTIZATION)
+
+
+def prepare_session(cmd, session_dir, cache=None):
+    # Masters and converted lights are journaled, so process_session picks up from calibration.
+    process_dir = process_folder(session_dir)
+    os.makedirs(process_dir, exist_ok=True)
+    journal = session_journal(session_dir)
+    build_masters(cmd, session_dir, process_dir, cache, journal)
+    convert_lights(cmd, session_dir, process_dir, journal)
+
+
+def fits_frames(frame_dir):
+    return [os.path.join(frame_dir, file_name) for file_name in sorted(os.listdir(frame_dir))
+            if file_name.lower().endswith(FITS_EXTENSIONS)]
+
+
+def native_supported(session_dir):
+    for folder in ('lights', 'darks', 'flats', 'biases'):
+        frame_dir = os.path.join(session_dir, folder)
+        if os.path.isdir(frame_dir):
+            frames = [file_name for file_name in os.listdir(frame_dir)
+                      if file_name.lower().endswith(FITS_EXTENSIONS + RAW_EXTENSIONS)]
+            if any(not file_name.lower().endswith(FITS_EXTENSIONS) for file_name in frames):
+                return False
+    return True
+
+
+@traced('native_master')
+def native_master(frame_dir, output, kind, params, cache, bit_depth, normalize=False, subtract=None, bias_key=None):
+    key, hit = cached_master(cache, frame_dir, kind, dict(params, bias=bias_key), output)
+    if not hit:
+        print(Fore.CYAN + f"Building master {kind} natively." + Style.RESET_ALL)
+        combine_frames(fits_frames(frame_dir), output, params['sigma_low'], params['sigma_high'], normalize,
+                       subtract, bit_depth, NATIVE_WORKERS, compression=COMPRESSION,
+                       quantization=COMPRESSION_QUANTIZATION)
+        if key:
+            cache.store(key, output)
+    return key
+
+
+def process_session_native(cmd, session_dir, process_dir, has_flats, has_darks, has_biases, cache, bit_depth,
+                           journal):
+    params = dict(MASTER_STACK_PARAMS, engine='native')
+    ext = frame_ext()
+    bias = os.path.join(process_dir, 'bias_stacked' + ext) if has_flats and has_biases else None
+    flat = os.path.join(process_dir, ('pp_flat_stacked' if bias else 'flat_stacked') + ext) if has_flats else None
+    dark = os.path.join(process_dir, 'dark_stacked' + ext) if has_darks else None
+
+    if not journal.done('masters'):
+        bias_key = None
+        if bias:
+            bias_key = native_master(os.path.join(session_dir, 'biases'), bias, 'bias', params, cache, bit_depth)
+        if flat:
+            native_master(os.path.join(session_dir, 'flats'), flat, 'flat', dict(params, norm='mul'), cache,
+                          bit_depth, normalize=True, subtract=bias, bias_key=bias_key)
+        if dark:
+            native_master(os.path.join(session_dir, 'darks'), dark, 'dark', params, cache, bit_depth)
+        journal.mark('masters', outputs=master_outputs(session_dir, process_dir))
+
+    lights_dir = os.path.join(session_dir, 'lights')
+    sources = fits_frames(lights_dir)
+    header, _ = image_info(sources[0])
+    cfa = header['NAXIS'] == 2 and 'BAYERPAT' in header
+    # CFA frames are written as light_ and still go through Siril once to be debayered.
+    prefix = 'light_' if cfa else 'pp_light_'
+    outputs = [os.path.join(process_dir, f"{prefix}{number:05d}{ext}") for number in range(1, len(sources) + 1)]
+
+    print(Fore.CYAN + f"{os.path.basename(session_dir)}: calibrating {len(sources)} lights natively."
+          + Style.RESET_ALL)
+    masters = prepare_masters(process_dir, dark, flat, cfa)
+    calibrate_frames(sources, outputs, masters, cfa, bit_depth, NATIVE_WORKERS, COMPRESSION, COMPRESSION_QUANTIZATION)
+    for path in masters.values():
+        if path:
+            os.remove(path)
+
+    with open(os.path.join(process_dir, 'light_conversion.txt'), 'w', encoding='utf-8') as f:
+        f.writelines(f"'{source}' -> '{os.path.basename(output)}'\n" for source, output in zip(sources, outputs))
+
+    if cfa:
+        write_seq_for_files(process_dir, 'light_')
+        cmd.cd(process_dir)
+        observer = start_watchdog(process_dir, 'pp')
+        try:
+            cmd.calibrate('light', cfa=True, equalize_cfa=True, debayer=True)
+        finally:
+            observer.stop()
+            observer.join()
+
+
+def calibrate_lights(cmd, has_rgb, has_mono, has_flats, has_darks, has_biases):
+    if has_rgb:
+        if has_flats and has_biases and has_darks:
+            cmd.calibrate('light', dark='dark_stacked', flat='pp_flat_stacked', cc='dark', cfa=True,
+                          equalize_cfa=True, debayer=True)
+
+        elif has_flats and has_biases and not has_darks:
+            cmd.calibrate('light', flat='pp_flat_stacked', cfa=True, equalize_cfa=True, debayer=True)
+
+        elif has_flats and not has_biases and has_darks:
+            cmd.calibrate('light', flat='flat_stacked', dark='dark_stacked', cc='dark', cfa=True,
+                          equalize_cfa=True, debayer=True)
+
+        elif has_flats and not has_biases and not has_darks:
+            cmd.calibrate('light', flat='flat_stacked', cfa=True, equalize_cfa=True, debayer=True)
+
+        elif not has_flats and not has_biases and has_darks:
+            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
+                          debayer=True)
+
+        elif not has_flats and has_biases and has_darks:
+            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
+                          debayer=True)
+            print(
+                Fore.RED + "Biases without flats are not supported for now. Skipping bias." + Style.RESET_ALL)
+
+
+        elif not has_flats and not has_biases and not has_darks:
+            cmd.calibrate('light', cfa=True, equalize_cfa=True, debayer=True)
+
+    if has_mono:
+        if has_flats and has_biases and has_darks:
+            cmd.calibrate('light', dark='dark_stacked', flat='pp_flat_stacked', cc='dark', cfa=True,
+                          equalize_cfa=True, debayer=False)
+
+        elif has_flats and has_biases and not has_darks:
+            cmd.calibrate('light', flat='pp_flat_stacked', cfa=True, equalize_cfa=True, debayer=False)
+
+        elif has_flats and not has_biases and has_darks:
+            cmd.calibrate('light', flat='flat_stacked', dark='dark_stacked', cc='dark', cfa=True,
+                          equalize_cfa=True, debayer=False)
+
+        elif has_flats and not has_biases and not has_darks:
+            cmd.calibrate('light', flat='flat_stacked', cfa=True, equalize_cfa=True, debayer=False)
+
+        elif not has_flats and not has_biases and has_darks:
+            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
+                          debayer=False)
+
+        # elif not has_flats and not has_biases and not has_darks:
+        #     cmd.calibrate('light', cfa=True, equalize_cfa=True, debayer=False)
+        #     cleanup(process_dir, 'light')
+        # A mono image that does not have any calibration frames cannot be
+        # calibrated, so it is immediately sent to calibrated and stacked
+
+
+def calibrate_chunk(cmd, session_dir, process_dir, chunk, start, has_rgb, has_mono, has_flats, has_darks,
+                    has_biases):
+    lights_dir = os.path.join(session_dir, 'lights')
+    # Staged beside the lights, where they can be hard-linked, so a process folder on a scratch volume only ever
+    # holds the converted and calibrated frames the chunk was sized for.
+    chunk_dir = os.path.join(session_dir, 'lights_chunk')
+    if os.path.isdir(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+    for path in chunk:
+        link_or_copy(path, os.path.join(chunk_dir, os.path.basename(path)))
+
+    convert_frames(cmd, chunk_dir, 'light', process_dir, start)
+    conversion = [f"'{os.path.join(lights_dir, os.path.basename(source))}' -> 'light_{number:05d}{frame_ext()}'\n"
+                  for number, source in sorted(read_conversion_file(process_dir, chunk_dir).items())]
+
+    cmd.cd(process_dir)
+    calibrate_lights(cmd, has_rgb, has_mono, has_flats, has_darks, has_biases)
+    cleanup(process_dir, 'light')
+    shutil.rmtree(chunk_dir)
+    return conversion
+
+
+def calibrate_in_chunks(cmd, session_dir, process_dir, chunks, has_rgb, has_mono, has_flats, has_darks,
+                        has_biases):
+    conversion = []
+    start = 1
+
+    for index, chunk in enumerate(chunks, start=1):
+        print(Fore.CYAN + f"{os.path.basename(session_dir)}: calibrating chunk {index}/{len(chunks)} "
+                          f"({len(chunk)} lights)." + Style.RESET_ALL)
+        conversion += calibrate_chunk(cmd, session_dir, process_dir, chunk, start, has_rgb, has_mono, has_flats,
+                                      has_darks, has_biases)
+        start += len(chunk)
+
+    with open(os.path.join(process_dir, 'light_conversion.txt'), 'w', encoding='utf-8') as f:
+        f.writelines(conversion)
+
+def frame_files(directory):
+    return [file_name for file_name in sorted(os.listdir(directory))
+            if file_name.lower().endswith(FITS_EXTENSIONS + RAW_EXTENSIONS)]
+
+
+def folder_settled(directory):
+    if os.path.isfile(os.path.join(directory, INGEST_MARKER)):
+        return True
+    files = frame_files(directory)
+    if not files:
+        return False
+    newest = max(os.path.getmtime(os.path.join(directory, file_name)) for file_name in files)
+    return time.time() - newest >= INGEST_SETTLE
+
+
+def stable_lights(lights_dir, seen, sizes, finished=False):
+    # A light is ready once its size is unchanged since the previous poll and it is no longer being written.
+    # Every light is complete once capture is marked finished, including those written just before the marker.
+    ready = []
+    for file_name in frame_files(lights_dir):
+        path = os.path.join(lights_dir, file_name)
+        if path in seen:
+            continue
+        stat = os.stat(path)
+        if finished or (sizes.get(path) == stat.st_size and time.time() - stat.st_mtime >= INGEST_POLL):
+            ready.append(path)
+        sizes[path] = stat.st_size
+    return ready
+
+
+def ingest_session(cmd, session_dir, cache=None):
+    lights_dir = os.path.join(session_dir, 'lights')
+    process_dir = process_folder(session_dir)
+    os.makedirs(process_dir, exist_ok=True)
+    journal = session_journal(session_dir)
+
+    has_flats = os.path.isdir(os.path.join(session_dir, "flats"))
+    has_darks = os.path.isdir(os.path.join(session_dir, "darks"))
+    has_biases = os.path.isdir(os.path.join(session_dir, "biases"))
+    calibration_dirs = [os.path.join(session_dir, folder) for folder in ('darks', 'flats', 'biases')
+                        if os.path.isdir(os.path.join(session_dir, folder))]
+
+    # cleanup() removes light_conversion.txt after every batch, so ingest keeps its own record to resume from.
+    ingest_file = os.path.join(process_dir, 'ingest_conversion.txt')
+    converted = read_conversion_file(process_dir, lights_dir, 'ingest') if os.path.isfile(ingest_file) else {}
+    seen = set(converted.values())
+    number = max(converted, default=0)
+    sizes = {}
+    pending = []
+    has_rgb = has_mono = None
+    masters_ready = journal.done('masters')
+
+    arrived = threading.Event()
+    observer = Observer()
+    for directory in [lights_dir] + calibration_dirs:
+        observer.schedule(IngestHandler(arrived), directory, recursive=False)
+    observer.start()
+    print(Fore.CYAN + f"Ingesting {lights_dir}. Drop a {INGEST_MARKER} file into it when capture is finished."
+          + Style.RESET_ALL)
+
+    last_arrival = time.time()
+    try:
+        while True:
+            finished = os.path.isfile(os.path.join(lights_dir, INGEST_MARKER))
+            idle = INGEST_IDLE_TIMEOUT is not None and time.time() - last_arrival > INGEST_IDLE_TIMEOUT
+
+            if not masters_ready and (finished or all(folder_settled(directory) for directory in calibration_dirs)):
+                print(Fore.CYAN + "Calibration frames complete, building masters." + Style.RESET_ALL)
+                build_masters(cmd, session_dir, process_dir, cache, journal)
+                masters_ready = True
+
+            ready = stable_lights(lights_dir, seen, sizes, finished)
+            if ready:
+                last_arrival = time.time()
+                seen.update(ready)
+                pending += ready
+
+            if masters_ready and pending and (len(pending) >= INGEST_BATCH or finished or idle):
+                batch, pending = pending[:INGEST_BATCH], pending[INGEST_BATCH:]
+                if has_rgb is None:
+                    color = frame_color(read_frame_info(batch[0]))
+                    has_rgb, has_mono = color == 'color', color == 'mono'
+                print(Fore.CYAN + f"{os.path.basename(session_dir)}: calibrating {len(batch)} new lights "
+                                  f"({number + len(batch)} so far)." + Style.RESET_ALL)
+                conversion = calibrate_chunk(cmd, session_dir, process_dir, batch, number + 1, has_rgb, has_mono,
+                                             has_flats, has_darks, has_biases)
+                with open(ingest_file, 'a', encoding='utf-8') as f:
+                    f.writelines(conversion)
+                number += len(batch)
+                continue
+
+            waiting = any(os.path.join(lights_dir, file_name) not in seen for file_name in frame_files(lights_dir))
+            if masters_ready and not pending and (finished or idle) and not ready and not waiting:
+                break
+            arrived.wait(INGEST_POLL)
+            arrived.clear()
+    except KeyboardInterrupt:
+        print(Fore.YELLOW + "Ingest interrupted. Run it again to resume." + Style.RESET_ALL)
+        return False
+    finally:
+        observer.stop()
+        observer.join()
+
+    if os.path.isfile(ingest_file):
+        shutil.copyfile(ingest_file, os.path.join(process_dir, 'light_conversion.txt'))
+        os.remove(ingest_file)
+    # The lights folder, not the ingest count, decides how many calibrated lights there must be.
+    lights = frame_files(lights_dir)
+    if has_rgb is None and lights:
+        color = frame_color(read_frame_info(os.path.join(lights_dir, lights[0])))
+        has_rgb, has_mono = color == 'color', color == 'mono'
+    calibrated = light_count(session_dir) if calibrates_lights(has_rgb, has_mono, has_flats, has_darks,
+                                                                has_biases) else 0
+    journal.mark('calibrate', frames=[(process_dir, 'pp_light_', calibrated)])
+    print(Fore.GREEN + f"{os.path.basename(session_dir)}: {number} lights calibrated during capture. "
+                       f"Only registration and stacking remain." + Style.RESET_ALL)
+    return True
+
+
+def session_journal(session_dir):
+    return StageJournal(os.path.join(process_folder(session_dir), 'journal.json'))
+
+
+def session_pending(session_dir):
+    # Once its frames start moving the session is not calibrated again, the rest of them are moved on the next run.
+    journal = session_journal(session_dir)
+    return not (journal.done('calibrate') or journal.done('moving') or journal.done('move'))
+
+
+def open_siril(siril_exe, bit_depth, app_class=Siril, wrapper_class=Wrapper):
+    app = app_class(siril_exe=siril_exe)
+    cmd = wrapper_class(app)
+    app.Open()
+
+    set_bit_depth(cmd, bit_depth)
+    cmd.setext('fit')
+    if COMPRESSION:
+        set_compression(app, bit_depth)
+    return app, cmd
+
+
+def set_compression(app, bit_depth, enabled=True):
+    if enabled and COMPRESSION:
+        # Checked here, before anything is written, with the rule the native engine and rawpy writes follow too.
+        check_compression(COMPRESSION, bit_depth, COMPRESSION_QUANTIZATION)
+        app.Execute(f"setcompress 1 -type={COMPRESSION} {COMPRESSION_QUANTIZATION}")
+    else:
+        app.Execute("setcompress 0")
+
+
+def set_bit_depth(cmd, bit_depth):
+    if bit_depth == '16':
+        cmd.set16bits()
+    elif bit_depth == '32':
+        cmd.set32bits()
+
+
+def find_sessions(workdir):
+    return [os.path.join(workdir, folder) for folder in sorted(os.listdir(workdir))
+            if folder.startswith('session_') and os.path.isdir(os.path.join(workdir, folder))]
+
+
+def session_worker(session_dir, siril_exe, bit_depth, has_rgb, has_mono, cache=None, chunks=None,
+                   opener=open_siril, settings=None):
+    # Worker processes do not inherit job overrides, so they are applied again here.
+    with job_settings(settings or {}):
+        app, cmd = opener(siril_exe, bit_depth)
+        if TRACE:
+            start_trace(os.path.join(os.path.dirname(session_dir), TRACE_FILE), process_folder(session_dir))
+            cmd = trace_wrapper(cmd)
+        try:
+            process_session(cmd, session_dir, has_rgb, has_mono, cache, chunks, bit_depth)
+        finally:
+            app.Close()
+    return session_dir
+
+
+def run_sessions_parallel(sessions, siril_exe, bit_depth, has_rgb, has_mono, workers, cache=None, plan=None,
+                          opener=open_siril):
+    workers = min(workers, len(sessions))
+    print(Fore.CYAN + f"Calibrating {len(sessions)} sessions with {workers} Siril workers." + Style.RESET_ALL)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(session_worker, session_dir, siril_exe, bit_depth, has_rgb, has_mono, cache,
+                                   (plan or {}).get(session_dir), opener, current_settings())
+                   for session_dir in sessions]
+        for future in as_completed(futures):
+            print(Fore.GREEN + f"Session {os.path.basename(future.result())} calibrated." + Style.RESET_ALL)
+
+
+def run_sessions_pipelined(cmd, sessions, siril_exe, bit_depth, has_rgb, has_mono, cache=None, plan=None,
+                           opener=open_siril):
+    plan = plan or {}
+    lookahead = max(PIPELINE_LOOKAHEAD, 1)
+    # One permit per session that is being calibrated or has been prepared ahead of it.
+    permits = threading.Semaphore(lookahead + 1)
+    prepared = queue.Queue()
+    stopped = threading.Event()
+    print(Fore.CYAN + f"Pipelining {len(sessions)} sessions, converting up to {lookahead} ahead." + Style.RESET_ALL)
+
+    def producer():
+        try:
+            app, prefetch_cmd = opener(siril_exe, bit_depth)
+            prefetch_cmd = trace_wrapper(prefetch_cmd)
+            try:
+                for session_dir in sessions:
+                    permits.acquire()
+                    if stopped.is_set():
+                        break
+                    native = CALIBRATION_ENGINE == 'native' and native_supported(session_dir)
+                    chunked = len(plan.get(session_dir) or []) > 1
+                    if not native and not chunked and session_pending(session_dir):
+                        prepare_session(prefetch_cmd, session_dir, cache)
+                    prepared.put((session_dir, None))
+            finally:
+                app.Close()
+        except Exception as e:
+            prepared.put((None, e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        for _ in sessions:
+            session_dir, error = prepared.get()
+            if error is not None:
+                raise error
+            process_session(cmd, session_dir, has_rgb, has_mono, cache, plan.get(session_dir), bit_depth)
+            permits.release()
+    finally:
+        stopped.set()
+        permits.release()
+        thread.join()
+
+@traced('stack_in_batches')
+def stack_in_batches(app, cmd, calibrated_folder, output, batch_size):
+    frames = sorted(file_name for file_name in os.listdir(calibrated_folder) if is_frame(file_name, 'r_pp_light_'))
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
+    batch_root = os.path.join(calibrated_folder, 'batches')
+    if os.path.isdir(batch_root):
+        shutil.rmtree(batch_root)
+    os.makedirs(batch_root)
+
+    for index, batch in enumerate(batches, start=1):
+        print(Fore.CYAN + f"Stacking batch {index}/{len(batches)} ({len(batch)} frames)." + Style.RESET_ALL)
+        batch_dir = os.path.join(batch_root, f"batch_{index:05d}")
+        os.makedirs(batch_dir)
+        for number, file_name in enumerate(batch, start=1):
+            link_or_copy(os.path.join(calibrated_folder, file_name),
+                         os.path.join(batch_dir, f"r_pp_light_{number:05d}{frame_suffix(file_name)}"))
+        write_seq_for_files(batch_dir, 'r_pp_light_')
+
+        cmd.cd(batch_dir)
+        cmd.stack('r_pp_light', type=STACKING_TYPE, sigma_low=SIGMA_LOW, sigma_high=SIGMA_HIGH,
+                  norm=NORMALIZATION, out=os.path.join(batch_root, f"substack_{index:05d}"))
+        shutil.rmtree(batch_dir)
+
+    # Sub-stacks are already pixel-rejected, so rejecting stacks are combined as a plain mean
+    # weighted by the number of frames each one holds (STACKCNT). Siril only takes normalization
+    # and weights for mean stacks, and sub-medians are already normalized.
+    if STACKING_TYPE in ('rej', 'mean'):
+        norm = '-nonorm' if NORMALIZATION == 'no' else f"-norm={NORMALIZATION}"
+        options = f"mean n {norm} -weight=nbstack -output_norm -rgb_equal"
+    elif STACKING_TYPE in ('med', 'median'):
+        options = "med -nonorm"
+    else:
+        options = STACKING_TYPE
+    write_seq_for_files(batch_root, 'substack_')
+    cmd.cd(batch_root)
+    app.Execute(f"stack substack_ {options} -out={output}")
+    cmd.cd(calibrated_folder)
+    shutil.rmtree(batch_root)
 
 def handle_console(settings_file):
     print(Fore.BLUE + "Quark-Coder multi-session processing script" + Style.RESET_ALL)
@@ -119,11 +841,11 @@ def handle_console(settings_file):
         print(Fore.CYAN + "Stacking started." + Style.RESET_ALL)
 
 
+@traced('cleanup')
 def cleanup(directory, prefix):
     for file in os.listdir(directory):
         if file.startswith(prefix + '_') and not file.startswith(prefix + '_stacked') and (
-                file.endswith('.fit') or file.endswith(
-            '.FIT') or file == prefix + '_.seq' or file == prefix + '_conversion.txt'):
+                is_frame(file) or file == prefix + '_.seq' or file == prefix + '_conversion.txt'):
             print(Fore.GREEN + "CLEANING " + file + Style.RESET_ALL)
             os.remove(os.path.join(directory, file))
         if prefix == 'all':
@@ -137,34 +859,87 @@ def batch_cleanup(alt_prefix, file_path):
     delete_path = os.path.join(directory, new_filename)
     print(Fore.CYAN + "BATCH-CLEANING " + new_filename + Style.RESET_ALL)
     if not delete_path.endswith('.seq'):
+        record_deletion('watchdog_cleanup', delete_path)
         os.remove(delete_path)
 
-def move_to_calibrated_folder(workdir, calibrated_folder):
-    existing_files = os.listdir(calibrated_folder)
-    max_number = 0
-    for file_name in existing_files:
-        if file_name.startswith('pp_light') and file_name.endswith('.fit'):
-            number_str = file_name.split('_')[-1].split('.')[0]
-            try:
-                number = int(number_str)
-                if number > max_number:
-                    max_number = number
-            except ValueError:
-                continue
+@traced('move_to_calibrated_folder')
+def move_to_calibrated_folder(workdir, calibrated_folder, catalog):
+    max_number = catalog.last_calibrated_number()
+    if not max_number:
+        numbers = [frame_number(file_name) for file_name in os.listdir(calibrated_folder)
+                   if is_frame(file_name, 'pp_light')]
+        max_number = max([number for number in numbers if number is not None], default=0)
 
     for session_folder in sorted(os.listdir(workdir)):
         session_path = os.path.join(workdir, session_folder)
         if os.path.isdir(session_path):
-            process_path = os.path.join(session_path, 'process')
+            process_path = process_folder(session_path)
             if os.path.isdir(process_path):
+                journal = session_journal(session_path)
+                if journal.done('move'):
+                    continue
+                sources = read_conversion_file(process_path, os.path.join(session_path, 'lights'))
+                journal.mark('moving')
+                moved = []
                 for file_name in sorted(os.listdir(process_path)):
-                    if file_name.startswith('pp_light') and file_name.endswith('.fit'):
+                    if is_frame(file_name, 'pp_light'):
                         src_file = os.path.join(process_path, file_name)
                         max_number += 1
-                        new_file_name = f"pp_light_{max_number:05d}.fit"
+                        new_file_name = f"pp_light_{max_number:05d}{frame_suffix(file_name)}"
                         dest_file = os.path.join(calibrated_folder, new_file_name)
-                        shutil.move(src_file, dest_file)
-                        print(Fore.GREEN + f'File {src_file} moved to {dest_file}' + Style.RESET_ALL)
+                        linked = transfer_frame(src_file, dest_file, CALIBRATED_LINK)
+                        moved.append(dest_file)
+                        catalog.add_calibrated(max_number, sources.get(frame_number(file_name)))
+                        print(Fore.GREEN + f'File {src_file} {"linked" if linked else "moved"} to {dest_file}'
+                              + Style.RESET_ALL)
+                catalog.commit()
+                journal.mark('move', outputs=moved)
+
+    if CALIBRATED_LINK:
+        write_seq_for_files(calibrated_folder, 'pp_light_')
+
+def link_reference(app, calibrated_folder, reference, number):
+    # New lights are registered against the retained reference so they line up with the frames kept before.
+    link_or_copy(reference, os.path.join(calibrated_folder, f"pp_light_{number:05d}{frame_suffix(reference)}"))
+    write_seq_for_files(calibrated_folder, 'pp_light_')
+    app.Execute(f"setref pp_light {count_frames(calibrated_folder, 'pp_light_')}")
+
+
+@traced('retain')
+def retain_registered(workdir, calibrated_folder, catalog, retained):
+    reference = sequence_reference(calibrated_folder, 'r_pp_light_')
+    last = catalog.last_calibrated_number()
+    sources = catalog.calibrated_sources()
+    sessions = {}
+    for file_name in sorted(os.listdir(calibrated_folder)):
+        if not is_frame(file_name, 'r_pp_light_'):
+            continue
+        number = frame_number(file_name)
+        path = os.path.join(calibrated_folder, file_name)
+        if number > last:
+            # The retained reference linked in for registration, already kept.
+            os.remove(path)
+            continue
+        if not sources.get(number):
+            print(Fore.YELLOW + f"Source of {file_name} is unknown, it is not retained." + Style.RESET_ALL)
+            continue
+        exptime = catalog.calibrated_exptime(number)
+        if exptime is None:
+            exptime = read_header(path).get('EXPTIME', 0)
+        session = os.path.relpath(sources[number], workdir).split(os.sep)[0]
+        sessions.setdefault(session, []).append((path, exptime))
+
+    reference_path = None
+    if reference is not None and reference <= last:
+        reference_path = next((path for frames in sessions.values() for path, _ in frames
+                               if frame_number(os.path.basename(path)) == reference), None)
+    kept = []
+    for session, frames in sorted(sessions.items()):
+        retained.retain(os.path.join(workdir, session), frames, reference_path)
+        kept += retained.frames(session)
+        print(Fore.GREEN + f"{session}: {len(frames)} registered lights retained." + Style.RESET_ALL)
+    return kept
+
 
 def setup_settings():
     dir_path = os.path.join(os.environ['APPDATA'], 'multisession-script')
@@ -257,10 +1032,16 @@ def setup_directories():
             exit()
     return workdir
 
-def check_directories(workdir):
+def image_types(summary):
+    has_rgb = any(counts['color'] for counts in summary.values())
+    has_mono = any(counts['mono'] for counts in summary.values())
+    return has_rgb, has_mono
+
+
+def check_directories(workdir, catalog, interactive=True):
     need_exit = False
 
-    for folder in os.listdir(workdir):
+    for folder in sorted(os.listdir(workdir)):
         if folder.startswith('session_'):
             folder_path = os.path.join(workdir, folder)
             folder_empty = False
@@ -273,25 +1054,6 @@ def check_directories(workdir):
             elif not os.listdir(lights_folder_path):
                 print(Fore.RED + f"{folder}: Lights folder is empty! Add files to it!" + Style.RESET_ALL)
                 folder_empty = True
-            else:
-                for file in os.listdir(lights_folder_path):
-                    if file.lower().endswith(('.fit', '.fits', '.raw', '.nef', '.cr2', '.cr3', '.arw')):
-                        file_path = os.path.join(lights_folder_path, file)
-                        try:
-                            if file.endswith(('.fit', '.FIT', '.fits', '.FITS')):
-                                with fits.open(file_path) as hdul:
-                                    data = hdul[0].data
-                                    if len(data.shape) == 3 and data.shape[0] == 3:
-                                        global HAS_RGB_IMAGES
-                                        HAS_RGB_IMAGES = True
-                                    elif len(data.shape) == 2:
-                                        global HAS_MONO_IMAGES
-                                        HAS_MONO_IMAGES = True
-                            elif file.lower().endswith(('.raw', '.nef', '.cr2', '.cr3', '.arw')):
-                                with rawpy.imread(file_path):
-                                    HAS_RGB_IMAGES = True
-                        except Exception as e:
-                            print(Fore.RED + f"Error reading {file}: {e}" + Style.RESET_ALL)
 
             flats_folder_path = os.path.join(folder_path, "flats")
             if os.path.isdir(flats_folder_path):
@@ -315,22 +1077,296 @@ def check_directories(workdir):
                 need_exit = True
 
     if need_exit:
+        if not interactive:
+            raise RuntimeError(f"Missing or empty frame folders in {workdir}.")
         os.system("pause")
         exit()
 
-    if HAS_RGB_IMAGES and HAS_MONO_IMAGES:
+    for file_path, e in catalog.scan(workdir, SCAN_THREADS):
+        print(Fore.RED + f"Error reading {os.path.basename(file_path)}: {e}" + Style.RESET_ALL)
+
+    summary = catalog.summary()
+    has_rgb, has_mono = image_types(summary)
+
+    if has_rgb and has_mono:
         print(
             Fore.RED + "Error: Both RGB and Monochrome images detected in lights "
                        "folders." + Style.RESET_ALL)
+        if not interactive:
+            raise RuntimeError(f"Both RGB and Monochrome images in {workdir}.")
         os.system("pause")
         exit()
 
-    if HAS_RGB_IMAGES:
+    if has_rgb:
         print(Fore.RED + "R" + Fore.GREEN + "G" + Fore.BLUE + "B" + Fore.WHITE + " images detected." + Style.RESET_ALL)
 
-    if HAS_MONO_IMAGES:
+    if has_mono:
         print(Back.WHITE + Fore.BLACK + "Monochrome images detected." + Style.RESET_ALL)
 
+    return summary
+
+def process_workdir(workdir, siril_exe, bit_depth, cache_dir=None, opener=open_siril, siril=None, interactive=True,
+                    copier=None):
+    trace_path = os.path.join(workdir, TRACE_FILE)
+    if TRACE:
+        if os.path.isfile(trace_path):
+            os.remove(trace_path)
+        start_trace(trace_path, calibrated_path(workdir))
+
+    catalog = FrameCatalog(os.path.join(workdir, 'frames.db'))
+    app = None
+    try:
+        has_rgb, has_mono = image_types(check_directories(workdir, catalog, interactive))
+
+        cache = None
+        if MASTER_CACHE and cache_dir:
+            cache = MasterCache(cache_dir, MASTER_CACHE_MAX_BYTES, bit_depth)
+
+        sessions = find_sessions(workdir)
+        journal = StageJournal(os.path.join(workdir, 'journal.json'))
+        registered = journal.done('register')
+        retained = RetainedFrames(os.path.join(workdir, 'retained')) if INCREMENTAL else None
+
+        budget = DISK_BUDGET_BYTES
+        if SCRATCH_DIR and not registered:
+            budget = check_scratch(catalog, [session_dir for session_dir in sessions
+                                             if not (retained and retained.current(session_dir))],
+                                   bit_depth, has_rgb, retained, budget)
+        scratch = scratch_root(SCRATCH_DIR, workdir) if SCRATCH_DIR else None
+        copy_back = copier or (CopyBack() if scratch else None)
+        if scratch and retained:
+            retained.stage(os.path.join(scratch, 'retained'), lambda src, dst: copy_back.copy(src, dst, workdir))
+        calibrated_folder = calibrated_path(workdir)
+        os.makedirs(calibrated_folder, exist_ok=True)
+        # Only intermediates are snapshotted, walking the light folders for every stage costs more than the stage.
+        add_trace_roots(calibrated_folder, *(process_folder(session_dir) for session_dir in sessions))
+
+        pending = [] if registered else [session_dir for session_dir in sessions if session_pending(session_dir)
+                                         and not (retained and retained.current(session_dir))]
+        if retained and len(pending) < len(sessions):
+            print(Fore.GREEN + f"{len(sessions) - len(pending)} session(s) already retained, processing "
+                               f"{len(pending)}." + Style.RESET_ALL)
+        parallel = SESSION_WORKERS > 1 and len(pending) > 1
+
+        plan = {}
+        workers = SESSION_WORKERS
+        masters_first = False
+        if budget and pending:
+            plan, workers, masters_first = plan_sessions(catalog, pending, bit_depth, has_rgb, budget,
+                                                         SESSION_WORKERS if parallel else 1)
+            parallel = parallel and workers > 1
+
+        # A shared Siril instance from a batch run stays open for the next target.
+        app, cmd = siril or opener(siril_exe, bit_depth)
+        cmd = trace_wrapper(cmd)
+
+        if masters_first:
+            for session_dir in pending:
+                if not (CALIBRATION_ENGINE == 'native' and native_supported(session_dir)):
+                    os.makedirs(process_folder(session_dir), exist_ok=True)
+                    build_masters(cmd, session_dir, process_folder(session_dir), cache, session_journal(session_dir))
+
+        if parallel:
+            run_sessions_parallel(pending, siril_exe, bit_depth, has_rgb, has_mono, workers, cache, plan, opener)
+
+        if not parallel:
+            if PIPELINE_LOOKAHEAD and len(pending) > 1:
+                run_sessions_pipelined(cmd, pending, siril_exe, bit_depth, has_rgb, has_mono, cache, plan, opener)
+            else:
+                for session_dir in pending:
+                    process_session(cmd, session_dir, has_rgb, has_mono, cache, plan.get(session_dir), bit_depth)
+
+        if not registered:
+            move_to_calibrated_folder(workdir, calibrated_folder, catalog)
+
+            if QUALITY_FILTER and not journal.done('quality'):
+                report = os.path.join(workdir, 'quality_scores.csv')
+                rejected = filter_frames(calibrated_folder, report, QUALITY_THRESHOLDS, QUALITY_BIN, SCAN_THREADS)
+                if rejected and os.path.isfile(os.path.join(calibrated_folder, 'pp_light_.seq')):
+                    write_seq_for_files(calibrated_folder, 'pp_light_')
+                journal.mark('quality', outputs=[report] if os.path.isfile(report) else [])
+
+            cleanup(calibrated_folder, 'r_pp_light')
+            cmd.cd(calibrated_folder)
+
+            expected = count_frames(calibrated_folder, 'pp_light_')
+            if retained is None or expected:
+                if retained and retained.reference():
+                    link_reference(app, calibrated_folder, retained.reference(), catalog.last_calibrated_number() + 1)
+                    expected += 1
+                observer = start_watchdog(calibrated_folder, 'r')
+                try:
+                    cmd.register('pp_light')
+                finally:
+                    observer.stop()
+                    observer.join()
+            journal.mark('register', frames=[(calibrated_folder, 'r_pp_light_', expected)])
+        else:
+            print(Fore.GREEN + "Registration already finished, resuming at stacking." + Style.RESET_ALL)
+
+        if retained is not None:
+            if not journal.done('retain'):
+                kept = retain_registered(workdir, calibrated_folder, catalog, retained)
+                journal.mark('retain', outputs=kept)
+            cleanup(calibrated_folder, 'r_pp_light')
+            retained.link_into(calibrated_folder)
+            write_seq_for_files(calibrated_folder, 'r_pp_light_')
+
+        cmd.cd(calibrated_folder)
+        if retained is not None:
+            result = 'result_' + str(retained.integration_time()) + 's'
+        else:
+            result = 'result_' + str(calculate_integration_time(calibrated_folder, catalog)) + 's'
+        if not journal.done('stack'):
+            # Only intermediates are compressed, the result is written as a plain FITS file.
+            if COMPRESSION:
+                set_compression(app, bit_depth, False)
+            if STACK_BATCH_SIZE and count_frames(calibrated_folder, 'r_pp_light_') > STACK_BATCH_SIZE:
+                stack_in_batches(app, cmd, calibrated_folder, os.path.join(os.path.dirname(calibrated_folder), result),
+                                 STACK_BATCH_SIZE)
+            else:
+                cmd.stack('r_pp_light', type=STACKING_TYPE, sigma_low=SIGMA_LOW, sigma_high=SIGMA_HIGH,
+                          norm=NORMALIZATION, output_norm=True, rgb_equal=True, out='../' + result)
+            if COMPRESSION:
+                set_compression(app, bit_depth)
+            journal.mark('stack', outputs=[os.path.join(os.path.dirname(calibrated_folder), result + '.fit')])
+
+        cleanup(calibrated_folder, 'all')
+        catalog.clear_calibrated()
+        for session_dir in sessions:
+            if os.path.isdir(process_folder(session_dir)):
+                cleanup(process_folder(session_dir), 'pp_light')
+            session_journal(session_dir).reset()
+        journal.reset()
+
+        if scratch:
+            # Intermediates are dropped with the scratch folder once the result and retained frames are copied back.
+            print(Fore.CYAN + f"Copying {result}.fit back to {workdir}." + Style.RESET_ALL)
+            copy_back.copy(os.path.join(scratch, result + '.fit'), os.path.join(workdir, result + '.fit'), workdir)
+            copy_back.remove(scratch, workdir)
+            if copier is None:
+                copy_back.wait()
+                copy_back.close()
+    finally:
+        # A failed target must not leave the catalog's transaction or its own Siril instance open.
+        if siril is None and app is not None:
+            app.Close()
+        catalog.close()
+    if TRACE:
+        stop_trace()
+        print_summary(trace_path)
+    # A batch run checks its shared copier once every target has been copied back.
+    if copier is None and copy_back and workdir in copy_back.failed:
+        raise RuntimeError(f"Copying back to {workdir} failed, the result and retained frames are kept in {scratch}.")
+    return os.path.join(workdir, result + '.fit')
+
+
+def check_scratch(catalog, sessions, bit_depth, debayer, retained, budget):
+    # Falls back to working beside the data when even the calibrated lights do not fit on the scratch volume,
+    # and otherwise calibrates in chunks sized to its free space.
+    global SCRATCH_DIR
+    kept, converted = estimate_peak(catalog, sessions, bit_depth, debayer)
+    if retained:
+        kept += sum(os.path.getsize(path) for path in retained.frames() if os.path.isfile(path))
+    free = scratch_free(SCRATCH_DIR)
+    if kept > free:
+        print(Fore.YELLOW + f"{SCRATCH_DIR} has {format_bytes(free)} free, less than the {format_bytes(kept)} the "
+                            f"calibrated lights need. Working beside the data instead." + Style.RESET_ALL)
+        SCRATCH_DIR = None
+        return budget
+    if kept + converted > free:
+        print(Fore.CYAN + f"{SCRATCH_DIR} has {format_bytes(free)} free for an estimated "
+                          f"{format_bytes(kept + converted)}, calibrating in chunks." + Style.RESET_ALL)
+        return min(budget or free, free)
+    return budget
+
+
+def run_jobs(job_file, siril_exe=None, bit_depth=None, opener=open_siril):
+    with open(job_file, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+
+    siril_exe = siril_exe or jobs.get('siril') or DEFAUT_SIRIL_PATH
+    bit_depth = str(bit_depth or jobs.get('bit_depth', '32'))
+    cache_dir = jobs.get('cache_dir')
+    defaults = jobs.get('settings', {})
+    cwd = os.getcwd()
+
+    print(Fore.BLUE + f"Batch mode: {len(jobs['jobs'])} target(s) from {job_file}." + Style.RESET_ALL)
+    siril = opener(siril_exe, bit_depth)
+    copy_back = CopyBack()
+    results = []
+    for index, job in enumerate(jobs['jobs'], start=1):
+        workdir = os.path.abspath(job['workdir'])
+        job_depth = str(job.get('bit_depth', bit_depth))
+        print(Fore.BLUE + f"[{index}/{len(jobs['jobs'])}] {workdir}" + Style.RESET_ALL)
+        start = time.time()
+        try:
+            if has_spaces(workdir):
+                raise ValueError(f"Space(-s) in the working directory path {workdir}.")
+            if not os.path.isdir(os.path.join(workdir, 'calibrated')):
+                raise ValueError(f"{workdir} has no calibrated folder.")
+            with job_settings(dict(defaults, **job.get('settings', {}))):
+                set_bit_depth(siril[1], job_depth)
+                set_compression(siril[0], job_depth)
+                result = process_workdir(workdir, siril_exe, job_depth, job.get('cache_dir', cache_dir), opener,
+                                         siril=siril, interactive=False, copier=copy_back)
+            results.append((workdir, True, time.time() - start, result))
+        except Exception as e:
+            print(Fore.RED + f"\n**** ERROR *** {workdir}: {str(e)}\n" + Style.RESET_ALL)
+            log_error_to_file(e)
+            results.append((workdir, False, time.time() - start, str(e)))
+            stop_trace()
+            # Siril may be left mid-command after a failure, so the next target gets a fresh instance.
+            siril[0].Close()
+            siril = opener(siril_exe, bit_depth)
+        finally:
+            os.chdir(cwd)
+    siril[0].Close()
+    # Results from a scratch volume are still being copied back while the next targets run.
+    copy_back.wait()
+    copy_back.close()
+    results = [(workdir, False, seconds, "copying back from the scratch folder failed")
+               if workdir in copy_back.failed else (workdir, ok, seconds, detail)
+               for workdir, ok, seconds, detail in results]
+
+    print(Fore.BLUE + "Batch summary:" + Style.RESET_ALL)
+    for workdir, ok, seconds, detail in results:
+        color = Fore.GREEN if ok else Fore.RED
+        print(color + f"  {'done' if ok else 'FAILED':<7}{seconds:>9.0f} s  {workdir}  {detail}" + Style.RESET_ALL)
+    return all(ok for _, ok, _, _ in results)
+
+
+def run_ingest(session_dir, siril_exe=None, bit_depth=None, cache_dir=None, opener=open_siril):
+    session_dir = os.path.abspath(session_dir)
+    bit_depth = bit_depth or '32'
+    if not os.path.isdir(os.path.join(session_dir, 'lights')):
+        print(Fore.RED + f"{session_dir} has no lights folder." + Style.RESET_ALL)
+        return False
+
+    cache = MasterCache(cache_dir, MASTER_CACHE_MAX_BYTES, bit_depth) if MASTER_CACHE and cache_dir else None
+    app, cmd = opener(siril_exe or DEFAUT_SIRIL_PATH, bit_depth)
+    if TRACE:
+        start_trace(os.path.join(os.path.dirname(session_dir), TRACE_FILE), process_folder(session_dir))
+        cmd = trace_wrapper(cmd)
+    try:
+        return ingest_session(cmd, session_dir, cache)
+    finally:
+        app.Close()
+        stop_trace()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Quark-Coder multi-session processing script. Without arguments "
+                                                 "the script runs interactively in the current directory.")
+    parser.add_argument('--jobs', help="JSON job file listing working directories to process unattended")
+    parser.add_argument('--ingest', metavar='SESSION_DIR',
+                        help="calibrate a session's lights in batches while they are being captured")
+    parser.add_argument('--siril', help="path to the Siril executable (overrides the job file)")
+    parser.add_argument('--bits', choices=['16', '32'], help="processing bit depth (overrides the job file)")
+    parser.add_argument('--cache-dir', help="master cache directory used while ingesting")
+    return parser.parse_args()
+
+
 def main():
 
     settings_file = setup_settings()
@@ -340,127 +1376,13 @@ def main():
     workdir = setup_directories()
 
     if os.path.isdir(os.path.join(workdir, "calibrated")):
-        check_directories(workdir)
-
         try:
             with open(settings_file, "r", encoding='utf-8') as settings:
                 lines = settings.readlines()
                 final_path = lines[0].strip()
                 bit_depth = lines[1].strip().replace('_bits', '')
 
-            app = Siril(siril_exe=final_path)
-            cmd = Wrapper(app)
-            app.Open()
-
-            if bit_depth == '16':
-                cmd.set16bits()
-            elif bit_depth == '32':
-                cmd.set32bits()
-
-            cmd.setext('fit')
-            for folder in os.listdir(workdir):
-                if folder.startswith('session_'):
-                    session_dir = os.path.join(workdir, folder)
-                    os.chdir(session_dir)
-                    process_dir = os.path.join(session_dir, "process")
-
-                    has_flats = os.path.isdir(os.path.join(session_dir, "flats"))
-                    has_darks = os.path.isdir(os.path.join(session_dir, "darks"))
-                    has_biases = os.path.isdir(os.path.join(session_dir, "biases"))
-
-                    if not os.path.exists(process_dir):
-                        os.makedirs(process_dir)
-
-                    if has_flats and has_biases:
-                        master_bias(cmd, os.path.join(session_dir, 'biases'), process_dir)
-                        master_flat(cmd, os.path.join(session_dir, 'flats'), process_dir, True)
-                    elif has_flats:
-                        master_flat(cmd, os.path.join(session_dir, 'flats'), process_dir, False)
-
-                    if has_darks:
-                        master_dark(cmd, os.path.join(session_dir, 'darks'), process_dir)
-
-                    cmd.cd(os.path.join(session_dir, 'lights'))
-                    cmd.convert('light', out=process_dir)
-                    cmd.cd(process_dir)
-
-                    observer = start_watchdog(process_dir, 'pp')
-
-                    if HAS_RGB_IMAGES:
-                        if has_flats and has_biases and has_darks:
-                            cmd.calibrate('light', dark='dark_stacked', flat='pp_flat_stacked', cc='dark', cfa=True,
-                                          equalize_cfa=True, debayer=True)
-
-                        elif has_flats and has_biases and not has_darks:
-                            cmd.calibrate('light', flat='pp_flat_stacked', cfa=True, equalize_cfa=True, debayer=True)
-
-                        elif has_flats and not has_biases and has_darks:
-                            cmd.calibrate('light', flat='flat_stacked', dark='dark_stacked', cc='dark', cfa=True,
-                                          equalize_cfa=True, debayer=True)
-
-                        elif has_flats and not has_biases and not has_darks:
-                            cmd.calibrate('light', flat='flat_stacked', cfa=True, equalize_cfa=True, debayer=True)
-
-                        elif not has_flats and not has_biases and has_darks:
-                            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
-                                          debayer=True)
-
-                        elif not has_flats and has_biases and has_darks:
-                            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
-                                          debayer=True)
-                            print(
-                                Fore.RED + "Biases without flats are not supported for now. Skipping bias." + Style.RESET_ALL)
-
-
-                        elif not has_flats and not has_biases and not has_darks:
-                            cmd.calibrate('light', cfa=True, equalize_cfa=True, debayer=True)
-
-                    if HAS_MONO_IMAGES:
-                        if has_flats and has_biases and has_darks:
-                            cmd.calibrate('light', dark='dark_stacked', flat='pp_flat_stacked', cc='dark', cfa=True,
-                                          equalize_cfa=True, debayer=False)
-
-                        elif has_flats and has_biases and not has_darks:
-                            cmd.calibrate('light', flat='pp_flat_stacked', cfa=True, equalize_cfa=True, debayer=False)
-
-                        elif has_flats and not has_biases and has_darks:
-                            cmd.calibrate('light', flat='flat_stacked', dark='dark_stacked', cc='dark', cfa=True,
-                                          equalize_cfa=True, debayer=False)
-
-                        elif has_flats and not has_biases and not has_darks:
-                            cmd.calibrate('light', flat='flat_stacked', cfa=True, equalize_cfa=True, debayer=False)
-
-                        elif not has_flats and not has_biases and has_darks:
-                            cmd.calibrate('light', dark='dark_stacked', cc='dark', cfa=True, equalize_cfa=True,
-                                          debayer=False)
-
-                        # elif not has_flats and not has_biases and not has_darks:
-                        #     cmd.calibrate('light', cfa=True, equalize_cfa=True, debayer=False)
-                        #     cleanup(process_dir, 'light')
-                        # A mono image that does not have any calibration frames cannot be
-                        # calibrated, so it is immediately sent to calibrated and stacked
-
-                    observer.stop()
-                    observer.join()
-
-
-            calibrated_folder = os.path.join(workdir, 'calibrated')
-
-            move_to_calibrated_folder(workdir, calibrated_folder)
-
-            cmd.cd(calibrated_folder)
-
-            observer = start_watchdog(calibrated_folder, 'r')
-            cmd.register('pp_light')
-            observer.stop()
-            observer.join()
-
-            cmd.stack('r_pp_light', type=STACKING_TYPE, sigma_low=SIGMA_LOW, sigma_high=SIGMA_HIGH, norm=NORMALIZATION,
-                      output_norm=True, rgb_equal=True, out='../' + 'result_' + str(calculate_integration_time(calibrated_folder)) + 's')
-
-            cleanup(calibrated_folder, 'all')
-
-            app.Close()
+            process_workdir(workdir, final_path, bit_depth, os.path.join(os.path.dirname(settings_file), 'masters'))
 
         except Exception as e:
             print(Fore.RED + f"\n**** ERROR *** {str(e)}\n" + Style.RESET_ALL)
@@ -470,4 +1392,10 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    args = parse_arguments()
+    if args.jobs:
+        exit(0 if run_jobs(args.jobs, args.siril, args.bits) else 1)
+    if args.ingest:
+        exit(0 if run_ingest(args.ingest, args.siril, args.bits, args.cache_dir) else 1)
     main()
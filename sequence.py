@@ -0,0 +1,71 @@
+import os
+
+from utils import is_frame, frame_suffix, link_or_copy
+
+SEQ_VERSION = 4
+
+
+def write_seq_file(directory, seqname, numbers, fixed=5, nb_layers=-1, compressed=False):
+    numbers = sorted(numbers)
+    seq_path = os.path.join(directory, seqname + '.seq')
+    with open(seq_path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write("#Siril sequence file. Contains list of images, selection, registration data and statistics\n")
+        f.write("#S 'sequence_name' start_index nb_images nb_selected fixed_len reference_image version "
+                "variable_size fz_flag\n")
+        f.write(f"S '{seqname}' {numbers[0] if numbers else 0} {len(numbers)} {len(numbers)} {fixed} -1 "
+                f"{SEQ_VERSION} 0 {int(compressed)}\n")
+        f.write(f"L {nb_layers}\n")
+        for number in numbers:
+            f.write(f"I {number} 1\n")
+    return seq_path
+
+
+def write_seq_for_files(directory, seqname, fixed=5):
+    numbers = []
+    compressed = False
+    for file_name in os.listdir(directory):
+        if is_frame(file_name, seqname):
+            suffix = frame_suffix(file_name)
+            number_str = file_name[len(seqname):-len(suffix)]
+            if number_str.isdigit():
+                numbers.append(int(number_str))
+                compressed = suffix.endswith('.fz')
+    return write_seq_file(directory, seqname, numbers, fixed, compressed=compressed)
+
+
+def sequence_names(basename, start, count, suffix='.fit'):
+    return [f"{basename}_{number:05d}{suffix}" for number in range(start, start + count)]
+
+
+def write_conversion_file(directory, basename, sources, names):
+    # Same format as the <basename>_conversion.txt Siril's convert leaves behind.
+    with open(os.path.join(directory, basename + '_conversion.txt'), 'w', encoding='utf-8') as f:
+        f.writelines(f"'{source}' -> '{name}'\n" for source, name in zip(sources, names))
+
+
+def link_sequence(sources, directory, basename, start=1, suffix='.fit'):
+    """Hard-link frames Siril can read as they are into directory as the <basename>_ sequence."""
+    names = sequence_names(basename, start, len(sources), suffix)
+    for source, name in zip(sources, names):
+        link_or_copy(source, os.path.join(directory, name))
+    write_conversion_file(directory, basename, sources, names)
+    write_seq_for_files(directory, basename + '_')
+    return [os.path.join(directory, name) for name in names]
+
+
+def sequence_reference(directory, seqname):
+    """File number of the reference image recorded in a Siril .seq file, or None when it is not set."""
+    seq_path = os.path.join(directory, seqname + '.seq')
+    if not os.path.isfile(seq_path):
+        return None
+    reference = -1
+    numbers = []
+    with open(seq_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('S '):
+                # beg, number, selnum, fixed_len, reference_image, ...
+                fields = line.rsplit("'", 1)[-1].split()
+                reference = int(fields[4]) if len(fields) > 4 else -1
+            elif line.startswith('I '):
+                numbers.append(int(line.split()[1]))
+    return numbers[reference] if 0 <= reference < len(numbers) else None
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip('pysiril')
+pytest.importorskip('watchdog')
+
+import script
+from benchmark import generate_tree
+from fake_siril import FakeSiril, open_fake_siril
+
+
+@pytest.mark.parametrize('stacking_type, normalization, options', [
+    ('rej', 'addscale', 'mean n -norm=addscale -weight=nbstack -output_norm -rgb_equal'),
+    ('rej', 'no', 'mean n -nonorm -weight=nbstack -output_norm -rgb_equal'),
+    ('med', 'addscale', 'med -nonorm'),
+    ('sum', 'addscale', 'sum'),
+])
+def test_substacks_are_combined_with_stack_options(tmp_path, monkeypatch, stacking_type, normalization, options):
+    commands = []
+    execute = FakeSiril.Execute
+
+    def record(self, command):
+        commands.append(command)
+        return execute(self, command)
+
+    monkeypatch.setattr(FakeSiril, 'Execute', record)
+    monkeypatch.chdir(tmp_path)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=1, lights=5, darks=2, flats=2, biases=2, width=48, height=32)
+    with script.job_settings({'stack_batch_size': 2, 'stacking_type': stacking_type, 'normalization': normalization,
+                              'master_cache': False}):
+        script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+
+    combines = [command for command in commands if command.startswith('stack substack_ ')]
+    assert len(combines) == 1
+    assert combines[0].startswith(f"stack substack_ {options} -out=")
@@ -0,0 +1,61 @@
+import os
+import shutil
+import threading
+import time
+import pytest
+
+pytest.importorskip('pysiril')
+pytest.importorskip('watchdog')
+
+import script
+from benchmark import generate_tree
+from fake_siril import open_fake_siril
+from journal import count_frames
+
+SETTINGS = {'ingest_poll': 0.2, 'ingest_batch': 4, 'master_cache': False}
+
+
+def test_ingest_after_capture_calibrates_every_light(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=1, lights=4, darks=2, flats=2, biases=2, width=48, height=32)
+    session_dir = os.path.join(workdir, 'session_1')
+    (tmp_path / 'target' / 'session_1' / 'lights' / script.INGEST_MARKER).write_text('')
+
+    with script.job_settings(SETTINGS):
+        assert script.run_ingest(session_dir, opener=open_fake_siril)
+        assert count_frames(script.process_folder(session_dir), 'pp_light_') == 4
+        result = script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+    assert os.path.basename(result) == 'result_240s.fit'
+
+
+def test_ingest_keeps_the_light_written_just_before_done(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = str(tmp_path / 'source')
+    generate_tree(source, sessions=1, lights=6, darks=2, flats=2, biases=2, width=48, height=32)
+    workdir = str(tmp_path / 'target')
+    session_dir = os.path.join(workdir, 'session_1')
+    for folder in ('darks', 'flats', 'biases'):
+        shutil.copytree(os.path.join(source, 'session_1', folder), os.path.join(session_dir, folder))
+    os.makedirs(os.path.join(workdir, 'calibrated'))
+    lights_dir = os.path.join(session_dir, 'lights')
+    os.makedirs(lights_dir)
+    names = sorted(os.listdir(os.path.join(source, 'session_1', 'lights')))
+
+    def capture():
+        for name in names[:-1]:
+            shutil.copyfile(os.path.join(source, 'session_1', 'lights', name), os.path.join(lights_dir, name))
+            time.sleep(0.1)
+        time.sleep(1)
+        # The last light lands right before the capture software marks the session finished.
+        shutil.copyfile(os.path.join(source, 'session_1', 'lights', names[-1]), os.path.join(lights_dir, names[-1]))
+        open(os.path.join(lights_dir, script.INGEST_MARKER), 'w').close()
+
+    camera = threading.Thread(target=capture)
+    with script.job_settings(SETTINGS):
+        camera.start()
+        try:
+            assert script.run_ingest(session_dir, opener=open_fake_siril)
+        finally:
+            camera.join()
+        assert count_frames(script.process_folder(session_dir), 'pp_light_') == 6
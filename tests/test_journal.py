@@ -0,0 +1,79 @@
+import os
+import pytest
+
+from journal import StageJournal
+
+
+def test_mark_rejects_missing_outputs_and_short_sequences(tmp_path):
+    journal = StageJournal(str(tmp_path / 'journal.json'))
+    for number in (1, 2):
+        (tmp_path / f"pp_light_{number:05d}.fit").write_bytes(b'')
+
+    with pytest.raises(RuntimeError):
+        journal.mark('masters', outputs=[str(tmp_path / 'dark_stacked.fit')])
+    with pytest.raises(RuntimeError):
+        journal.mark('calibrate', frames=[(str(tmp_path), 'pp_light_', 3)])
+    assert not journal.done('masters') and not journal.done('calibrate')
+
+    journal.mark('calibrate', frames=[(str(tmp_path), 'pp_light_', 2)])
+    assert journal.done('calibrate')
+
+
+def test_failed_calibrate_is_not_journaled(tmp_path, monkeypatch):
+    pytest.importorskip('pysiril')
+    pytest.importorskip('watchdog')
+    import script
+    from benchmark import generate_tree
+    from fake_siril import FakeWrapper, open_fake_siril
+
+    monkeypatch.chdir(tmp_path)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=2, lights=3, darks=2, flats=2, biases=2, width=48, height=32)
+    calibrate = FakeWrapper.calibrate
+
+    def fail_session_2(self, seqname, **options):
+        # pysiril returns a failure instead of raising, so the stand-in simply writes nothing.
+        if seqname == 'light' and 'session_2' in self.app.cwd:
+            return False
+        return calibrate(self, seqname, **options)
+
+    with script.job_settings({'master_cache': False}):
+        monkeypatch.setattr(FakeWrapper, 'calibrate', fail_session_2)
+        with pytest.raises(RuntimeError, match='calibrate'):
+            script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+
+        monkeypatch.setattr(FakeWrapper, 'calibrate', calibrate)
+        result = script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+    assert os.path.basename(result) == 'result_360s.fit'
+
+
+def test_failed_move_releases_the_catalog(tmp_path, monkeypatch):
+    pytest.importorskip('pysiril')
+    pytest.importorskip('watchdog')
+    import script
+    from benchmark import generate_tree
+    from catalog import FrameCatalog
+    from fake_siril import open_fake_siril
+
+    monkeypatch.chdir(tmp_path)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=2, lights=3, darks=2, flats=2, biases=2, width=48, height=32)
+    add_calibrated = FrameCatalog.add_calibrated
+    added = []
+
+    def fail_second(self, number, source):
+        # The first frame is already recorded, uncommitted, when the move fails.
+        added.append(number)
+        if len(added) == 2:
+            raise OSError('move failed')
+        return add_calibrated(self, number, source)
+
+    with script.job_settings({'master_cache': False}):
+        monkeypatch.setattr(FrameCatalog, 'add_calibrated', fail_second)
+        with pytest.raises(OSError, match='move failed'):
+            script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+
+        monkeypatch.setattr(FrameCatalog, 'add_calibrated', add_calibrated)
+        result = script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+    # The frames moved before the failure are not calibrated and stacked a second time.
+    assert os.path.basename(result) == 'result_360s.fit'
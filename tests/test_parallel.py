@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('pysiril')
+pytest.importorskip('watchdog')
+
+from astropy.io import fits
+
+import script
+from benchmark import generate_tree
+from fake_siril import open_fake_siril
+from utils import is_frame
+
+
+def run_workdir(monkeypatch, workdir, workers):
+    calibrated = {}
+    cleanup = script.cleanup
+
+    def keep_calibrated(directory, prefix):
+        # The registered frames are deleted with the calibrated folder, so they are read just before.
+        if prefix == 'all':
+            for name in sorted(os.listdir(directory)):
+                if is_frame(name, 'r_pp_light_'):
+                    calibrated[name] = fits.getdata(os.path.join(directory, name)).astype(np.float32)
+        cleanup(directory, prefix)
+
+    monkeypatch.setattr(script, 'cleanup', keep_calibrated)
+    generate_tree(str(workdir), sessions=3, lights=4, darks=3, flats=3, biases=3, width=64, height=48)
+    with script.job_settings({'session_workers': workers, 'master_cache': False}):
+        result = script.process_workdir(str(workdir), None, '32', opener=open_fake_siril, interactive=False)
+    return result, calibrated
+
+
+def test_parallel_sessions_match_serial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    serial, serial_frames = run_workdir(monkeypatch, tmp_path / 'serial', 1)
+    parallel, parallel_frames = run_workdir(monkeypatch, tmp_path / 'parallel', 2)
+
+    assert os.path.basename(parallel) == os.path.basename(serial)
+    assert sorted(parallel_frames) == sorted(serial_frames)
+    assert len(serial_frames) == 12
+    for name, data in serial_frames.items():
+        np.testing.assert_allclose(parallel_frames[name], data, atol=1e-6)
+    np.testing.assert_allclose(fits.getdata(parallel), fits.getdata(serial), atol=1e-6)
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from engine import write_fits
+from quality import filter_frames, frame_scores
+
+
+def write_lights(directory, compression):
+    rng = np.random.default_rng(0)
+    stars = np.zeros((64, 96), dtype=np.float32)
+    stars[rng.integers(4, 60, 20), rng.integers(4, 92, 20)] = 0.5
+    for number in range(1, 7):
+        # The fourth frame is shot through cloud-lit sky.
+        background = 0.4 if number == 4 else 0.1
+        data = background + stars + rng.normal(0, 0.005, stars.shape).astype(np.float32)
+        write_fits(os.path.join(directory, f"pp_light_{number:05d}.fit"), data, fits.Header(), '16', compression)
+
+
+@pytest.mark.parametrize('compression', [None, 'rice'])
+def test_filter_scores_16_bit_frames(tmp_path, compression):
+    write_lights(str(tmp_path), compression)
+    score = frame_scores(str(tmp_path / 'pp_light_00001.fit'), 2)
+    assert score['background'] == pytest.approx(0.1 * 65535, rel=0.05)
+
+    rejected = filter_frames(str(tmp_path), str(tmp_path / 'quality_scores.csv'), {'background': 3.0}, threads=1)
+    assert rejected == ['pp_light_00004.fit']
+    assert not (tmp_path / 'pp_light_00004.fit').exists()
+    assert (tmp_path / 'quality_scores.csv').is_file()
@@ -0,0 +1,83 @@
+import os
+import pytest
+
+import scratch
+from scratch import CopyBack
+
+
+def test_failed_copy_keeps_scratch_folder(tmp_path, monkeypatch):
+    kept, removed = tmp_path / 'kept', tmp_path / 'removed'
+    for directory in (kept, removed):
+        directory.mkdir()
+        (directory / 'result.fit').write_bytes(b'result')
+    copy_file = scratch.copy_file
+
+    def fail_kept(src, dst):
+        if src.startswith(str(kept)):
+            raise OSError('disk full')
+        copy_file(src, dst)
+
+    monkeypatch.setattr(scratch, 'copy_file', fail_kept)
+    copy_back = CopyBack()
+    for directory in (kept, removed):
+        copy_back.copy(str(directory / 'result.fit'), str(tmp_path / 'out' / directory.name / 'result.fit'),
+                       directory.name)
+        copy_back.remove(str(directory), directory.name)
+    copy_back.wait()
+    copy_back.close()
+
+    assert copy_back.failed == {'kept'}
+    assert (kept / 'result.fit').is_file()
+    assert not removed.exists()
+    assert (tmp_path / 'out' / 'removed' / 'result.fit').read_bytes() == b'result'
+
+
+def test_process_workdir_reports_failed_copy_back(tmp_path, monkeypatch):
+    pytest.importorskip('pysiril')
+    pytest.importorskip('watchdog')
+    import script
+    from benchmark import generate_tree
+    from fake_siril import open_fake_siril
+
+    def fail(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(scratch, 'copy_file', fail)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=1, lights=3, darks=2, flats=2, biases=2, width=48, height=32)
+    scratch_dir = str(tmp_path / 'scratch')
+    with script.job_settings({'scratch_dir': scratch_dir, 'master_cache': False}):
+        with pytest.raises(RuntimeError, match='Copying back'):
+            script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+
+    root = scratch.scratch_root(scratch_dir, workdir)
+    assert os.path.isfile(os.path.join(root, 'result_180s.fit'))
+    assert not os.path.exists(os.path.join(workdir, 'result_180s.fit'))
+
+
+def test_chunks_are_not_staged_on_scratch(tmp_path, monkeypatch):
+    pytest.importorskip('pysiril')
+    pytest.importorskip('watchdog')
+    import script
+    from benchmark import generate_tree
+    from fake_siril import open_fake_siril
+
+    staged = []
+    link_or_copy = script.link_or_copy
+
+    def record(src, dst):
+        staged.append(dst)
+        link_or_copy(src, dst)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(script, 'link_or_copy', record)
+    workdir = str(tmp_path / 'target')
+    generate_tree(workdir, sessions=1, lights=4, darks=2, flats=2, biases=2, width=48, height=32)
+    scratch_dir = str(tmp_path / 'scratch')
+    with script.job_settings({'scratch_dir': scratch_dir, 'disk_budget_bytes': 60000, 'master_cache': False}):
+        result = script.process_workdir(workdir, None, '32', opener=open_fake_siril, interactive=False)
+
+    assert os.path.basename(result) == 'result_240s.fit'
+    assert len(staged) == 4
+    assert not any(path.startswith(scratch_dir) for path in staged)
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import shutil
+import threading
+import functools
+
+from contextlib import contextmanager
+from datetime import datetime
+from colorama import Fore, Style
+
+from catalog import FITS_EXTENSIONS, RAW_EXTENSIONS
+from scheduler import format_bytes
+from utils import is_frame, frame_suffix
+
+TRACE_FILE = 'trace.jsonl'
+
+_tracer = None
+
+
+def tree_snapshot(directory):
+    snapshot = {}
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_ino, stat.st_mtime_ns)
+    return snapshot
+
+
+def snapshot_delta(before, after):
+    # Files are matched by inode so renamed or moved frames count as neither written nor deleted.
+    before_ids = {(ino, mtime) for _, ino, mtime in before.values()}
+    after_inodes = {ino for _, ino, _ in after.values()}
+    written = [size for size, ino, mtime in after.values() if (ino, mtime) not in before_ids]
+    deleted = [size for size, ino, _ in before.values() if ino not in after_inodes]
+    return sum(written), len(written), sum(deleted), len(deleted)
+
+
+def disk_free(directory):
+    # Folders such as calibrated/ are created part way through a run, so the volume is found from a parent.
+    while directory and not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+    try:
+        return shutil.disk_usage(directory).free
+    except OSError:
+        return None
+
+
+def sequence_inputs(directory, method, args):
+    if not args or not os.path.isdir(directory):
+        return []
+    if method == 'convert':
+        extensions = FITS_EXTENSIONS + RAW_EXTENSIONS
+        return [os.path.join(directory, name) for name in os.listdir(directory)
+                if name.lower().endswith(extensions)]
+    prefix = str(args[0]).rstrip('_') + '_'
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if is_frame(name, prefix) and name[len(prefix):-len(frame_suffix(name))].isdigit()]
+
+
+class Tracer:
+    def __init__(self, path, *roots):
+        # Free space is reported for the first root, where intermediates are written.
+        self.path = path
+        self.roots = []
+        self.add_roots(*roots)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add_roots(self, *roots):
+        for root in roots:
+            root = os.path.normpath(os.path.abspath(root))
+            if root not in self.roots:
+                self.roots.append(root)
+
+    def record(self, stage, started, seconds, **fields):
+        entry = {'stage': stage, 'started': datetime.fromtimestamp(started).isoformat(timespec='milliseconds'),
+                 'seconds': round(seconds, 3), 'depth': getattr(self.local, 'depth', 0), 'pid': os.getpid()}
+        entry.update(fields)
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def snapshot(self):
+        snapshot = {}
+        for root in self.roots:
+            snapshot.update(tree_snapshot(root))
+        return snapshot
+
+    @contextmanager
+    def stage(self, name, frames=None, read=0, **details):
+        free_before = disk_free(self.roots[0])
+        before = self.snapshot()
+        depth = getattr(self.local, 'depth', 0)
+        started = time.time()
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            seconds = time.time() - started
+            after = self.snapshot()
+            for snapshot in (before, after):
+                snapshot.pop(self.path, None)
+            written, files_written, deleted, files_deleted = snapshot_delta(before, after)
+            self.record(name, started, seconds, frames=frames, read=read, written=written,
+                        files_written=files_written, deleted=deleted, files_deleted=files_deleted,
+                        free_before=free_before, free_after=disk_free(self.roots[0]), **details)
+
+
+class TracedWrapper:
+    """Proxy around a pysiril Wrapper that traces every command as its own stage."""
+
+    def __init__(self, cmd, tracer):
+        self.cmd = cmd
+        self.tracer = tracer
+        self.cwd = os.getcwd()
+
+    def __getattr__(self, name):
+        method = getattr(self.cmd, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            if name == 'cd':
+                self.cwd = os.path.join(self.cwd, str(args[0]))
+                return method(*args, **kwargs)
+            inputs = sequence_inputs(self.cwd, name, args)
+            read = sum(os.path.getsize(path) for path in inputs if os.path.isfile(path))
+            with self.tracer.stage(name, frames=len(inputs), read=read, sequence=str(args[0]) if args else None,
+                                   directory=self.cwd):
+                return method(*args, **kwargs)
+        return call
+
+
+def start_trace(path, *roots):
+    global _tracer
+    _tracer = Tracer(path, *roots)
+    return _tracer
+
+
+def add_trace_roots(*roots):
+    # Session folders are only known once the working directory has been scanned.
+    if _tracer is not None:
+        _tracer.add_roots(*roots)
+
+
+def stop_trace():
+    global _tracer
+    _tracer = None
+
+
+def trace_wrapper(cmd):
+    return TracedWrapper(cmd, _tracer) if _tracer and not isinstance(cmd, TracedWrapper) else cmd
+
+
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def call(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.stage(name):
+                return function(*args, **kwargs)
+        return call
+    return decorator
+
+
+def record_deletion(stage, path):
+    # Watchdog deletions run once per frame, so they are recorded without a tree snapshot.
+    if _tracer is None or not os.path.isfile(path):
+        return
+    size = os.path.getsize(path)
+    _tracer.record(stage, time.time(), 0, deleted=size, files_deleted=1)
+
+
+def summarize(path):
+    stages = {}
+    if not os.path.isfile(path):
+        return stages
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            stage = stages.setdefault(entry['stage'], {'calls': 0, 'seconds': 0.0, 'frames': 0, 'read': 0,
+                                                       'written': 0, 'deleted': 0, 'min_free': None})
+            stage['calls'] += 1
+            stage['seconds'] += entry['seconds']
+            for field in ('frames', 'read', 'written', 'deleted'):
+                stage[field] += entry.get(field) or 0
+            for free in (entry.get('free_before'), entry.get('free_after')):
+                if free is not None and (stage['min_free'] is None or free < stage['min_free']):
+                    stage['min_free'] = free
+    return stages
+
+
+def print_summary(path):
+    stages = summarize(path)
+    if not stages:
+        return
+    print(Fore.BLUE + "Stage summary (nested stages are included in their parents):" + Style.RESET_ALL)
+    print(f"  {'stage':<27}{'calls':>7}{'seconds':>10}{'frames':>8}{'read':>12}{'written':>12}{'deleted':>12}"
+          f"{'min free':>12}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        min_free = format_bytes(stage['min_free']) if stage['min_free'] is not None else '-'
+        print(f"  {name:<27}{stage['calls']:>7}{stage['seconds']:>10.2f}{stage['frames']:>8}"
+              f"{format_bytes(stage['read']):>12}{format_bytes(stage['written']):>12}"
+              f"{format_bytes(stage['deleted']):>12}{min_free:>12}")
+    print(" ")
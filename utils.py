@@ -1,4 +1,5 @@
 import os
+import shutil
 import traceback
 import logging
 
@@ -7,6 +8,8 @@ from astropy.io import fits
 
 log_file = "script_log.txt"
 
+FRAME_SUFFIXES = ('.fit', '.fit.fz')
+
 logging.basicConfig(
     filename=log_file,
     level=logging.ERROR,
@@ -25,14 +28,60 @@ def log_error_to_file(exception: Exception):
 def has_spaces(path):
     return ' ' in path
 
-def calculate_integration_time(calibrated_folder):
+def frame_number(file_name):
+    number_str = os.path.basename(file_name).split('_')[-1].split('.')[0]
+    try:
+        return int(number_str)
+    except ValueError:
+        return None
+
+def is_frame(file_name, prefix=''):
+    return file_name.startswith(prefix) and file_name.lower().endswith(FRAME_SUFFIXES)
+
+def frame_suffix(file_name):
+    return '.fit.fz' if file_name.lower().endswith('.fz') else '.fit'
+
+def image_hdu(hdul):
+    # Tile-compressed files keep an empty primary HDU and store the image in the first extension.
+    if len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return hdul[1]
+    return hdul[0]
+
+def read_header(file_path):
+    with fits.open(file_path) as hdul:
+        return image_hdu(hdul).header.copy()
+
+def calculate_integration_time(calibrated_folder, catalog=None):
     total_exposure_time = 0.0
     for fits_file in os.listdir(calibrated_folder):
-        if fits_file.endswith('.fits') and fits_file.startswith('r_pp_light') or fits_file.endswith(
-                '.fit') and fits_file.startswith('r_pp_light'):
-            file_path = os.path.join(calibrated_folder, fits_file)
-            with fits.open(file_path) as hdul:
-                hdr = hdul[0].header
-                if 'EXPTIME' in hdr:
-                    total_exposure_time += hdr['EXPTIME']
-    return int(total_exposure_time)
\ No newline at end of file
+        if fits_file.endswith('.fits') and fits_file.startswith('r_pp_light') or is_frame(fits_file, 'r_pp_light'):
+            exposure_time = None
+            if catalog is not None:
+                exposure_time = catalog.calibrated_exptime(frame_number(fits_file))
+            if exposure_time is None:
+                file_path = os.path.join(calibrated_folder, fits_file)
+                exposure_time = read_header(file_path).get('EXPTIME', 0)
+            total_exposure_time += exposure_time
+    return int(total_exposure_time)
+
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def transfer_frame(src, dst, link=False):
+    if not link:
+        shutil.move(src, dst)
+        return False
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        os.replace(src, dst)
+        return False
+    try:
+        os.symlink(src, dst)
+        return True
+    except OSError:
+        shutil.move(src, dst)
+        return False